@@ -0,0 +1,49 @@
+import argparse
+import copy
+import time
+
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+import torch
+
+from lex.inference.device import prepare_model
+from lex.inference.sampling import sample_batch
+
+
+def benchmark(model, prompt_ids, new_tokens, batch_size, runs):
+    eos_id = -1  # never sampled, so every row decodes exactly `new_tokens` tokens
+    lengths = [len(prompt_ids) + new_tokens] * batch_size
+    sample_batch(model, [prompt_ids] * batch_size, lengths, [eos_id] * batch_size)  # warm-up
+    a = time.perf_counter()
+    for _ in range(runs):
+        sample_batch(model, [prompt_ids] * batch_size, lengths, [eos_id] * batch_size)
+    return runs * batch_size * new_tokens / (time.perf_counter() - a)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='gpt2-medium')
+    parser.add_argument('--model-path', type=str)
+    parser.add_argument('--num-threads', type=int, default=0)
+    parser.add_argument('--prompt', type=str, default='Steve how do i get to spawn |Alex ')
+    parser.add_argument('--new-tokens', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    tokenizer = GPT2Tokenizer.from_pretrained(args.model)
+    model = GPT2LMHeadModel.from_pretrained(args.model)
+    if args.model_path:
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    prompt_ids = tokenizer.encode(args.prompt)
+    fp32_model = prepare_model(copy.deepcopy(model), device='cpu', num_threads=args.num_threads)
+    int8_model = prepare_model(model, device='cpu', quantize=True, num_threads=args.num_threads)
+
+    print(f'{args.model} on CPU, {torch.get_num_threads()} threads, batch size {args.batch_size}')
+    fp32_tps = benchmark(fp32_model, prompt_ids, args.new_tokens, args.batch_size, args.runs)
+    print(f'fp32: {fp32_tps:.1f} tokens/sec')
+    int8_tps = benchmark(int8_model, prompt_ids, args.new_tokens, args.batch_size, args.runs)
+    print(f'int8: {int8_tps:.1f} tokens/sec ({int8_tps / fp32_tps:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
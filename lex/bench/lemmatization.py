@@ -0,0 +1,49 @@
+import argparse
+import random
+import time
+
+from lex.utils import message as msg_utils
+from lex.utils.lemma import StanzaLemmatizer, DictionaryLemmatizer
+
+
+CHAT_LINES = ['how do i vote', 'gg', 'where can you vote?', 'who is the best', 'how to get to spawn',
+              'does anyone have diamonds to trade', 'lol that creeper blew up my house', 'can someone tp me',
+              'what are the server rules', 'I was building a castle near the river yesterday',
+              'how do I bend', 'brb', 'whos the best player here', 'my villagers keep dying, any ideas?']
+
+
+def make_messages(count):
+    rng = random.Random(0)
+    return [f'{rng.choice(CHAT_LINES)} {idx}' for idx in range(count)]
+
+
+def run(name, fn, messages, batch_size):
+    fn(messages[:batch_size])  # warm-up
+    a = time.perf_counter()
+    for idx in range(0, len(messages), batch_size):
+        fn(messages[idx:idx + batch_size])
+    print(f'{name}: {len(messages) / (time.perf_counter() - a):.1f} messages/sec')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+    messages = make_messages(args.count)
+
+    import stanza
+    full_pipeline = stanza.Pipeline(msg_utils.NLP_SETTINGS.nlp_lang)  # what msg_utils.nlp used to run
+    run('full pipeline (baseline)',
+        lambda xs: [' '.join(w.lemma for s in full_pipeline(x).sentences for w in s.words) for x in xs],
+        messages,
+        1)
+    settings = msg_utils.NlpSettings(nlp_processors='tokenize,pos,lemma')
+    lemmatizer = StanzaLemmatizer(msg_utils.build_pipeline(settings))
+    run('tokenize,pos,lemma', lambda xs: [lemmatizer.lemmatize(x) for x in xs], messages, 1)
+    run(f'tokenize,pos,lemma batched x{args.batch_size}', lemmatizer.lemmatize_batch, messages, args.batch_size)
+    run('dictionary', DictionaryLemmatizer().lemmatize_batch, messages, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import random
+import re
+import time
+
+from lex.utils.regex import RegexIndex
+
+
+VERBS = ['craft', 'find', 'buy', 'sell', 'claim', 'vote', 'build', 'enchant', 'repair', 'trade']
+
+
+def make_rules(count):
+    return [re.compile(rf'^(how|where) (do|can) (?P<who>you|i) {VERBS[idx % len(VERBS)]} item{idx}( .*)?$',
+                       re.IGNORECASE) for idx in range(count)]
+
+
+def make_messages(count, num_rules):
+    rng = random.Random(0)
+    messages = []
+    for _ in range(count):
+        idx = rng.randrange(num_rules)
+        if rng.random() < 0.5:
+            messages.append(f'how do i {VERBS[idx % len(VERBS)]} item{idx} fast')
+        else:
+            messages.append(f'does anyone have item{idx}')  # matches nothing, the common case
+    return messages
+
+
+def match_loop(rules, text):
+    for idx, rgx in enumerate(rules):
+        m = rgx.match(text)
+        if m is not None:
+            return idx, m.groups(), m.groupdict()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='10,100,1000,5000')
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+    print(f'{"rules":>6} {"loop us/msg":>12} {"indexed us/msg":>16} {"compile ms":>11}')
+    for size in map(int, args.sizes.split(',')):
+        rules = make_rules(size)
+        messages = make_messages(args.messages, size)
+        a = time.perf_counter()
+        matcher = RegexIndex(rules)
+        compile_ms = (time.perf_counter() - a) * 1000
+        a = time.perf_counter()
+        expected = [match_loop(rules, x) for x in messages]
+        loop_us = (time.perf_counter() - a) / len(messages) * 1e6
+        a = time.perf_counter()
+        actual = [matcher.match(x) for x in messages]
+        indexed_us = (time.perf_counter() - a) / len(messages) * 1e6
+        assert actual == expected
+        print(f'{size:>6} {loop_us:>12.1f} {indexed_us:>16.1f} {compile_ms:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
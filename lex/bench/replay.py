@@ -0,0 +1,219 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+from lex.core import MinecraftDiscordCore, BotSettings
+from lex.module import mystic, dialogue, mystic_qa
+from lex.utils.metrics import METRICS
+import lex.utils.message as msg_utils
+
+
+BOT_NAME = 'Lex'
+BRIDGE_FORMAT = '‹**{author}**› {text}'  # as parsed by MinecraftDiscordCore.minecraft_message_rgx
+AUTHORS = ['Steve', 'Alex', 'Notch', 'Herobrine', 'jeb_', 'Dinnerbone', 'Grumm', 'Kingbdogz']
+SYNTHETIC_MESSAGES = [  # (weight, text)
+    (40, 'anyone want to go mining'),
+    (10, 'lol'),
+    (10, 'how do i vote'),
+    (5, 'where can u vote'),
+    (10, '12*(3+4)^2'),
+    (10, '@{bot} sample {other}'),
+    (5, '@{bot} reply {other} where is spawn'),
+    (10, '@{bot} how are you today'),
+]
+
+
+class FakeUser:
+    _ids = itertools.count(1)
+
+    def __init__(self, name: str):
+        self.id = next(self._ids)
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{self.id}>'
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeChannel', author: FakeUser, content: str):
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.mentions = []  # type: List[FakeUser]
+        self.edits = []  # type: List[str]
+
+    async def edit(self, content: str):
+        self.content = self.clean_content = content
+        self.edits.append(content)
+
+
+class FakeChannel:
+    # Records what the bot sends instead of talking to Discord.
+
+    def __init__(self, channel_id: int, name: str, bot: FakeUser):
+        self.id = channel_id
+        self.name = name
+        self.bot = bot
+        self.sent = []  # type: List[FakeMessage]
+
+    async def send(self, content: str) -> FakeMessage:
+        message = FakeMessage(self, self.bot, content)
+        self.sent.append(message)
+        return message
+
+    async def trigger_typing(self):
+        pass
+
+
+def synthetic_log(count: int, num_channels: int, bridged: float, seed: int = 0) -> List[Tuple[str, str, str]]:
+    rng = random.Random(seed)
+    weights, texts = zip(*SYNTHETIC_MESSAGES)
+    log = []
+    for _ in range(count):
+        author, other = rng.sample(AUTHORS, 2)
+        text = rng.choices(texts, weights)[0].format(bot=BOT_NAME.lower(), other=other)
+        channel = f'channel-{rng.randrange(num_channels)}'
+        if rng.random() < bridged:
+            log.append((channel, 'Bridge', BRIDGE_FORMAT.format(author=author, text=text)))
+        else:
+            log.append((channel, author, text))
+    return log
+
+
+def read_log(path: str) -> List[Tuple[str, str, str]]:
+    # A recorded log is a TSV of channel, author and message content; bridged lines keep the bridge format.
+    with open(path, newline='') as f:
+        return [(x[0], x[1], x[2]) for x in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE) if len(x) >= 3]
+
+
+def build_tiny_model(path: str, seed: int = 0):
+    # A randomly initialized two-layer GPT-2 over a byte-level vocabulary with ' |' merged into one token, so the
+    # sampling code paths run as they do with the real models, on a CPU and without any download.
+    from transformers import GPT2Config, GPT2LMHeadModel
+    from transformers.tokenization_gpt2 import bytes_to_unicode
+    import torch
+    vocab = {x: idx for idx, x in enumerate(bytes_to_unicode().values())}
+    vocab['Ġ|'] = len(vocab)
+    vocab['<|endoftext|>'] = len(vocab)
+    with open(os.path.join(path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\nĠ |\n')
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(vocab), n_positions=256, n_ctx=256, n_embd=64, n_layer=2, n_head=2)
+    GPT2LMHeadModel(config).save_pretrained(path)
+
+
+def build_modules(preset: str, model: str, model_path: str, quantize: bool):
+    if preset == 'mysticmessenger':
+        return [dialogue.DialogueModule(dialogue.DialogueSettings(dialogue_model=model,
+                                                                  dialogue_model_path=model_path,
+                                                                  dialogue_device='cpu',
+                                                                  dialogue_quantize=quantize,
+                                                                  dialogue_reply_delay=0))]
+    return [mystic.MysticBotModule(mystic.MysticSettings(sample_model=model,
+                                                         sample_model_path=model_path,
+                                                         sample_device='cpu',
+                                                         sample_quantize=quantize)),
+            mystic_qa.MysticQaBotModule(mystic_qa.QaSettings())]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+async def replay(core: MinecraftDiscordCore, log: List[Tuple[str, str, str]], rate: float) -> Dict[str, List[float]]:
+    # Returns latencies per intent, from the arrival of each message until its handler finished.
+    bot = core.user
+    channels = {}  # type: Dict[str, FakeChannel]
+    users = {}  # type: Dict[str, FakeUser]
+    arrivals = {}  # type: Dict[int, float]
+    latencies = defaultdict(list)  # type: Dict[str, List[float]]
+
+    def on_done(job, _):
+        arrival = arrivals.pop(id(job.message.disc_message), None)
+        if arrival is not None:
+            latencies[job.prediction.intent.fq_name].append(time.perf_counter() - arrival)
+
+    core.ingest.listeners.append(on_done)
+    start = time.perf_counter()
+    for idx, (channel_name, author_name, content) in enumerate(log):
+        if rate > 0:
+            await asyncio.sleep(max(0.0, start + idx / rate - time.perf_counter()))
+        channel = channels.setdefault(channel_name, FakeChannel(len(channels) + 1, channel_name, bot))
+        author = users.setdefault(author_name, FakeUser(author_name))
+        message = FakeMessage(channel, author, content)
+        arrival = time.perf_counter()
+        arrivals[id(message)] = arrival
+        received = core.ingest.received
+        await core.on_message(message)
+        if core.ingest.received == received:  # no intent, or rate limited
+            arrivals.pop(id(message))
+            latencies['(unrouted)'].append(time.perf_counter() - arrival)
+        await asyncio.sleep(0)
+    while not core.ingest.is_idle:
+        await asyncio.sleep(0.01)
+    core.ingest.listeners.remove(on_done)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', type=str, default='', help='mysticmessenger for the dialogue bot')
+    parser.add_argument('--log', type=str, help='TSV of channel, author, content; synthetic chat if omitted')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--bridged', type=float, default=0.3, help='fraction of synthetic lines sent by the bridge')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second; 0 replays as fast as possible')
+    parser.add_argument('--model', type=str, default='tiny', help='tiny for a random two-layer GPT-2')
+    parser.add_argument('--model-path', type=str, default='')
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--nlp-backend', type=str, default='dictionary')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the rate limits from the environment')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    msg_utils.NLP_SETTINGS.nlp_backend = args.nlp_backend
+    model = args.model
+    if model == 'tiny':
+        model = tempfile.mkdtemp(prefix='lex-tiny-gpt2-')
+        build_tiny_model(model, args.seed)
+    log = read_log(args.log) if args.log else synthetic_log(args.messages, args.channels, args.bridged, args.seed)
+    limits = {} if args.rate_limit else dict(rate_author_interval=0, rate_channel_interval=0, rate_global_interval=0)
+    settings = BotSettings(api_token='replay', mention_workaround='', preset_name=args.preset, **limits)
+    modules = build_modules(args.preset, model, args.model_path, args.quantize)
+    core = MinecraftDiscordCore(settings, modules)
+    core._connection.user = FakeUser(BOT_NAME)
+
+    loop = asyncio.get_event_loop()
+    a = time.perf_counter()
+    loop.run_until_complete(core.warmup())
+    print(f'Warm-up: {time.perf_counter() - a:.2f}s')
+    a = time.perf_counter()
+    latencies = loop.run_until_complete(replay(core, log, args.rate))
+    elapsed = time.perf_counter() - a
+
+    print(f'{len(log)} messages in {elapsed:.2f}s: {len(log) / elapsed:.1f} messages/sec')
+    print(f'{"intent":>24} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for intent, values in sorted(latencies.items()):
+        p50, p95, p99 = (percentile(values, q) * 1000 for q in (50, 95, 99))
+        print(f'{intent:>24} {len(values):>6} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}')
+    print('Ingestion: ' + ', '.join(f'{k} {v}' for k, v in core.ingest.stats().items()))
+    for module in modules:
+        if getattr(module, 'pool', None) is not None:
+            print(f'Sample pool ({module.name}): ' + ', '.join(f'{k} {v}' for k, v in module.pool.stats().items()))
+    print(f'Stages:\n{METRICS.summary()}')
+
+
+if __name__ == '__main__':
+    main()
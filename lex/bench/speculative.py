@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+
+import torch
+
+from lex.inference import ModelRegistry
+from lex.inference.sampling import sample_batch
+from lex.utils.metrics import METRICS
+import lex.utils.message as msg_utils
+
+
+PROMPTS = ['Steve how do i get to spawn |Alex ', 'Alex anyone want to go mining |Notch ', 'jeb_ lol |Steve ',
+           'Notch where can i vote |Herobrine ', 'Dinnerbone my villagers keep dying, any ideas? |Grumm ']
+
+
+def draft_counts():
+    return (METRICS.counter('lex_draft_tokens_total', result='proposed').value,
+            METRICS.counter('lex_draft_tokens_total', result='accepted').value)
+
+
+def run(model, tokenizer, args, draft_model=None, num_draft_tokens=4):
+    # Generates like sample_gpt2 does, with the ' |' EOS and <|endoftext|> stopping rows. Returns tokens/sec, the
+    # draft acceptance rate and a decoded sample.
+    eos_id = tokenizer.encode(' |')[0]
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+    batches = [[tokenizer.encode(rng.choice(PROMPTS)) for _ in range(args.batch_size)] for _ in range(args.runs)]
+    proposed, accepted = draft_counts()
+    num_tokens = 0
+    text = ''
+    a = time.perf_counter()
+    for prompts in batches:
+        outputs = sample_batch(model,
+                               prompts,
+                               [len(x) + args.new_tokens for x in prompts],
+                               [eos_id] * len(prompts),
+                               min_lengths=[len(x) + args.min_tokens for x in prompts],
+                               suppress_token_ids=(tokenizer.eos_token_id,),
+                               stop_token_ids=(tokenizer.eos_token_id,),
+                               draft_model=draft_model,
+                               num_draft_tokens=num_draft_tokens)
+        num_tokens += sum(len(x) for x in outputs)
+        text = msg_utils.decode_sample(tokenizer, outputs[0])
+    elapsed = time.perf_counter() - a
+    new_proposed, new_accepted = draft_counts()
+    rate = (new_accepted - accepted) / max(new_proposed - proposed, 1)
+    return num_tokens / elapsed, rate, text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='gpt2-medium')
+    parser.add_argument('--model-path', type=str, default='')
+    parser.add_argument('--draft-model', type=str, default='distilgpt2')
+    parser.add_argument('--draft-tokens', type=str, default='2,4,6')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--num-threads', type=int, default=0)
+    parser.add_argument('--new-tokens', type=int, default=48)
+    parser.add_argument('--min-tokens', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    registry = ModelRegistry.instance()
+    tokenizer = registry.tokenizer(args.model)
+    model = registry.model(args.model, args.model_path, device=args.device, quantize=args.quantize,
+                           num_threads=args.num_threads)
+    draft_model = registry.model(args.draft_model, device=args.device, quantize=args.quantize,
+                                 num_threads=args.num_threads)
+    run(model, tokenizer, args)  # warm-up
+
+    print(f'{args.model} with draft {args.draft_model} on {args.device}, batch size {args.batch_size}')
+    base_tps, _, text = run(model, tokenizer, args)
+    print(f'{"plain":>10}: {base_tps:7.1f} tokens/sec {text!r}')
+    for num_draft_tokens in (int(x) for x in args.draft_tokens.split(',')):
+        tps, rate, text = run(model, tokenizer, args, draft_model, num_draft_tokens)
+        print(f'{f"draft x{num_draft_tokens}":>10}: {tps:7.1f} tokens/sec ({tps / base_tps:.2f}x), '
+              f'{rate:.0%} accepted {text!r}')
+
+
+if __name__ == '__main__':
+    main()
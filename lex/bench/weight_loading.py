@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def load(method: str, model: str, model_path: str):
+    # Runs in a fresh process, so peak RSS covers this load alone.
+    from transformers import GPT2LMHeadModel
+    import torch
+    from lex.inference.weights import load_finetuned
+    torch.set_grad_enabled(False)
+    a = time.perf_counter()
+    if method == 'legacy':  # what ModelRegistry used to do
+        gpt2 = GPT2LMHeadModel.from_pretrained(model)
+        gpt2.load_state_dict(torch.load(model_path, map_location='cpu'))
+    else:
+        gpt2 = load_finetuned(model, model_path)
+    gpt2.eval()
+    load_secs = time.perf_counter() - a
+    load_rss = rss_mb()
+    a = time.perf_counter()
+    gpt2(torch.arange(16).unsqueeze(0))  # mapped pages are only read once they are used
+    forward_secs = time.perf_counter() - a
+    print(json.dumps(dict(load_secs=load_secs,
+                          forward_secs=forward_secs,
+                          load_rss_mb=load_rss,
+                          rss_mb=rss_mb(),
+                          peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='gpt2-medium')
+    parser.add_argument('--model-path', type=str, default='gpt2-medium.pt',
+                        help='fine-tuned weights; the base weights are saved there if it does not exist')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return load(args.child, args.model, args.model_path)
+
+    from lex.inference.weights import convert_checkpoint, mmap_path
+    if not os.path.exists(args.model_path):
+        from transformers import GPT2LMHeadModel
+        import torch
+        torch.save(GPT2LMHeadModel.from_pretrained(args.model).state_dict(), args.model_path)
+    a = time.perf_counter()
+    convert_checkpoint(args.model_path, mmap_path(args.model_path))
+    print(f'One-time conversion to {mmap_path(args.model_path)}: {time.perf_counter() - a:.2f}s')
+
+    # Runs alternate, so both methods see a similarly warm page cache.
+    results = {'legacy': [], 'mmap': []}
+    for _ in range(args.runs):
+        for method in results:
+            command = [sys.executable, '-m', 'lex.bench.weight_loading', '--child', method,
+                       '--model', args.model, '--model-path', args.model_path]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            results[method].append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f'{args.model}, {args.model_path}, best of {args.runs}')
+    print(f'{"method":>8} {"load s":>8} {"forward s":>10} {"RSS MB":>8} {"peak RSS MB":>12}')
+    for method, runs in results.items():
+        best = min(runs, key=lambda x: x['load_secs'])
+        print(f'{method:>8} {best["load_secs"]:>8.2f} {best["forward_secs"]:>10.3f} {best["rss_mb"]:>8.0f} '
+              f'{max(x["peak_rss_mb"] for x in runs):>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
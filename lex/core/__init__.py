@@ -1,3 +1,6 @@
 from .bot import *
 from .settings import *
 from .intent import *
+from .stream import *
+from .ingest import *
+from .ratelimit import *
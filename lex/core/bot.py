@@ -1,11 +1,18 @@
 from dataclasses import dataclass, field
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+import math
 import re
+import time
 
 import discord as disc
 
-from .intent import IntentPredictor, Intent, IntentRegistry, IntentPrediction
+from .ingest import IngestionQueue
+from .ratelimit import RateLimit, RateLimiter
+from .intent import IntentPredictor, Intent, IntentRegistry, IntentPrediction, LemmaRegexIntentPredictor
+from lex.utils.cache import ExpiringLruCache
+from lex.utils.metrics import METRICS, timed, serve_metrics, log_metrics
 import lex.core
+import lex.utils.message as msg_utils
 
 
 __all__ = ['MinecraftDiscordCore', 'AuthoredMessage', 'BotModule']
@@ -28,6 +35,10 @@ class BotModule:
     def on_finalize(self):
         pass
 
+    def on_warmup(self):
+        # Runs on a worker thread after login; load models and other lazily built state here.
+        pass
+
     def register_intent(self, intent: Intent):
         intent.namespace = self.name
         IntentRegistry.instance().register(intent)
@@ -47,34 +58,150 @@ class MinecraftDiscordCore(disc.Client):
         super().__init__()
         self.settings = settings  # type: lex.core.BotSettings
         self.modules = modules
+        self.start_time = time.perf_counter()
+        self.warmed_up = False
+        self.ingest = IngestionQueue(settings.ingest_workers,
+                                     max_costly_workers=settings.ingest_costly_workers,
+                                     channel_queue_size=settings.ingest_queue_size,
+                                     coalesce=settings.ingest_coalesce)
+        author_interval = settings.rate_author_interval
+        if settings.sample_cooldown is not None:
+            print('SAMPLE_COOLDOWN is deprecated, set RATE_AUTHOR_INTERVAL instead')
+            author_interval = settings.sample_cooldown
+        if settings.cooldowns:
+            print('COOLDOWNS is deprecated, set RATE_AUTHOR_INTERVALS instead')
+        author_limits = {name: RateLimit(interval, settings.rate_author_burst)
+                         for name, interval in dict(settings.cooldowns, **settings.rate_author_intervals).items()}
+        self.rate_limiter = RateLimiter(RateLimit(author_interval, settings.rate_author_burst),
+                                        RateLimit(settings.rate_channel_interval, settings.rate_channel_burst),
+                                        RateLimit(settings.rate_global_interval, settings.rate_global_burst),
+                                        author_overrides=author_limits,
+                                        max_keys=settings.rate_max_keys)
+        self.limit_notified = ExpiringLruCache(maxsize=settings.rate_max_keys)
+        self.ingest.drop_listeners.append(self.release_rate_limit)
+        self.metrics_started = False
+        self.register_metrics()
         for module in self.modules:
             module.on_finalize()
 
+    def register_metrics(self):
+        METRICS.gauge('lex_ingest_queued', lambda: self.ingest.num_queued, 'Messages waiting for a worker')
+        METRICS.gauge('lex_ingest_running', lambda: self.ingest.num_running, 'Messages being handled')
+        for name in ('dropped', 'coalesced', 'failed'):
+            METRICS.gauge(f'lex_ingest_{name}_total', lambda name=name: getattr(self.ingest, name), kind='counter')
+        METRICS.gauge('lex_rate_limited_total', lambda: self.rate_limiter.limited, kind='counter')
+        request = self.http.request
+
+        async def timed_request(route, **kwargs):
+            # Every REST call to Discord: sends, edits, typing, including time spent waiting out rate limits
+            with timed('lex_discord_request_seconds', method=route.method, path=route.path):
+                return await request(route, **kwargs)
+        self.http.request = timed_request
+
+    async def start_metrics(self):
+        if self.settings.metrics_port:
+            await serve_metrics(self.settings.metrics_host, self.settings.metrics_port)
+            print(f'Serving metrics on http://{self.settings.metrics_host}:{self.settings.metrics_port}/metrics')
+        if self.settings.metrics_log_interval > 0:
+            self.loop.create_task(log_metrics(self.settings.metrics_log_interval))
+
+    async def on_ready(self):
+        print(f'Ready as {self.user} after {time.perf_counter() - self.start_time:.2f}s')
+        if not self.metrics_started:
+            self.metrics_started = True
+            await self.start_metrics()
+        if self.settings.warmup and not self.warmed_up:
+            self.warmed_up = True
+            self.loop.create_task(self.warmup())
+
+    async def warmup(self):
+        tasks = [(module.name, module.on_warmup) for module in self.modules]
+        if any(isinstance(p, LemmaRegexIntentPredictor) for m in self.modules for p in m.predictors):
+            tasks.insert(0, ('nlp', msg_utils.get_lemmatizer))
+        for name, task in tasks:
+            a = time.perf_counter()
+            try:
+                await self.loop.run_in_executor(None, task)
+            except Exception as e:
+                print(f'Warm-up of {name} failed: {e!r}')
+                continue
+            print(f'Warmed up {name} in {time.perf_counter() - a:.2f}s')
+
     async def on_message(self, message: disc.Message):
         if message.author == self.user:
             return
-        m = self.minecraft_message_rgx.match(message.clean_content)
-        if m:
-            author_name = m.group(1).replace('\\_', '_')
-            message_content = m.group(2)
-        else:
-            author_name = message.author.display_name
-            message_content = message.clean_content
-        mtext = self.settings.mention_workaround
-        mentioned = self.user in message.mentions or (mtext and mtext in message.clean_content) or \
-            f'@{self.user.display_name.lower()}' in message.clean_content.lower()
-        message_content = message_content.replace(f'@{self.user.display_name}', '')
-        message_content = message_content.replace(f'@{self.user.display_name.lower()}', '')
-        if mtext:
-            message_content = message_content.replace(mtext, '')
-        message_content = message_content.strip()
-        amsg = AuthoredMessage(message, message_content, author_name)
-        amsg.attributes['self-mention'] = mentioned  # TODO: move to separate processing class
+        METRICS.counter('lex_messages_total').inc()
+        with timed('lex_parse_seconds'):
+            m = self.minecraft_message_rgx.match(message.clean_content)
+            if m:
+                author_name = m.group(1).replace('\\_', '_')
+                message_content = m.group(2)
+            else:
+                author_name = message.author.display_name
+                message_content = message.clean_content
+            mtext = self.settings.mention_workaround
+            mentioned = self.user in message.mentions or (mtext and mtext in message.clean_content) or \
+                f'@{self.user.display_name.lower()}' in message.clean_content.lower()
+            message_content = message_content.replace(f'@{self.user.display_name}', '')
+            message_content = message_content.replace(f'@{self.user.display_name.lower()}', '')
+            if mtext:
+                message_content = message_content.replace(mtext, '')
+            message_content = message_content.strip()
+            amsg = AuthoredMessage(message, message_content, author_name)
+            amsg.attributes['self-mention'] = mentioned  # TODO: move to separate processing class
         await self.on_authored_message(amsg)
 
+    def predict_intent(self, message: AuthoredMessage) -> Optional[IntentPrediction]:
+        # Same result as taking the first maximum over every prediction of every predictor, but cheap predictors
+        # run first and a predictor is skipped once its upper bound can't beat (or, being later, tie) the best so far.
+        predictors = list(enumerate(p for m in self.modules for p in m.predictors))
+        for _, predictor in predictors:
+            predictor.observe(message)
+        max_pred = None  # type: Optional[IntentPrediction]
+        max_order = 0
+        for order, predictor in sorted(predictors, key=lambda x: x[1].cost):
+            if max_pred is not None:
+                bound = predictor.upper_bound(message)
+                if bound < max_pred.rel or (bound == max_pred.rel and order > max_order):
+                    continue
+            with timed('lex_predict_seconds', predictor=type(predictor).__name__):
+                preds = predictor.predict(message)
+            for pred in preds:
+                if max_pred is None or pred.rel > max_pred.rel or (pred.rel == max_pred.rel and order < max_order):
+                    max_pred, max_order = pred, order
+        return max_pred
+
     async def on_authored_message(self, message: AuthoredMessage):
         print(f'{message.author_name}> {message.message_content}')
-        intents = [x for m in self.modules for p in m.predictors for x in p.predict(message)]
-        max_pred = max(intents, key=lambda x: x.rel)  # type: IntentPrediction
-        if max_pred.rel > 0:
-            await max_pred.intent.handle(message, max_pred.data)
+        if any(isinstance(p, LemmaRegexIntentPredictor) for m in self.modules for p in m.predictors):
+            await msg_utils.prefetch_lemmas([message.message_content])
+        max_pred = self.predict_intent(message)
+        if max_pred is None or max_pred.rel <= 0:
+            return
+        channel = message.disc_message.channel
+        wait = self.rate_limiter.acquire(message.author_name,
+                                         channel.id,
+                                         cost=max_pred.intent.cost,
+                                         channel_name=getattr(channel, 'name', None))
+        if wait > 0:
+            await self.notify_rate_limited(message, wait)
+            return
+        self.ingest.put(channel.id, message, max_pred)
+
+    def release_rate_limit(self, job):
+        # A dropped or superseded job never runs, so its author gets its tokens back.
+        channel = job.message.disc_message.channel
+        self.rate_limiter.release(job.message.author_name,
+                                  channel.id,
+                                  cost=job.prediction.intent.cost,
+                                  channel_name=getattr(channel, 'name', None))
+
+    async def notify_rate_limited(self, message: AuthoredMessage, wait: float):
+        # Tells an author once per limit interval, so that being throttled doesn't produce a message per request.
+        key = message.author_name
+        now = time.monotonic()
+        if now < self.limit_notified.get(key, 0):
+            return
+        interval = self.rate_limiter.author_limit(getattr(message.disc_message.channel, 'name', None)).interval
+        self.limit_notified.put(key, now + max(interval, wait))
+        await message.disc_message.channel.send(f'Please wait {math.ceil(wait)} seconds, {message.author_name}.')
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import asyncio
+import itertools
+import time
+import traceback
+
+from .intent import IntentPrediction
+from lex.utils.metrics import METRICS
+
+
+__all__ = ['IngestionQueue']
+
+
+@dataclass
+class IngestJob:
+    message: Any  # AuthoredMessage
+    prediction: IntentPrediction
+    seq: int
+    enqueued: float
+
+    @property
+    def cost(self) -> int:
+        return self.prediction.intent.cost
+
+
+class IngestionQueue:
+    # Bounded per-channel queues of predicted messages, drained by a fixed set of workers. Workers take the cheapest
+    # queued job first (oldest among equals), and at most `max_costly_workers` of them handle costly intents at once,
+    # so cheap answers keep flowing while generation is saturated. A full channel sheds its oldest costliest job, or
+    # the incoming job if everything queued is cheaper. A costly job from an author who already has the same intent
+    # queued in the channel replaces that job in place.
+
+    def __init__(self,
+                 num_workers: int = 4,
+                 max_costly_workers: int = 2,
+                 channel_queue_size: int = 16,
+                 coalesce: bool = True):
+        self.num_workers = num_workers
+        self.max_costly_workers = min(max_costly_workers, num_workers)
+        self.channel_queue_size = channel_queue_size
+        self.coalesce = coalesce
+        self.channels = OrderedDict()  # type: Dict[Hashable, List[IngestJob]]
+        self.seq = itertools.count()
+        self.workers = []  # type: List[asyncio.Task]
+        self.job_ready = None  # type: Optional[asyncio.Event]
+        self.listeners = []  # type: List[Callable[[IngestJob, float], None]]  # called with each finished job's latency
+        self.drop_listeners = []  # type: List[Callable[[IngestJob], None]]  # called with each job that won't run
+        self.num_running = 0
+        self.num_costly = 0
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.handled = 0
+        self.failed = 0
+
+    @property
+    def num_queued(self) -> int:
+        return sum(len(x) for x in self.channels.values())
+
+    @property
+    def is_idle(self) -> bool:
+        return self.num_running == 0 and not self.channels
+
+    def stats(self) -> Dict[str, int]:
+        return dict(received=self.received,
+                    coalesced=self.coalesced,
+                    dropped=self.dropped,
+                    handled=self.handled,
+                    failed=self.failed,
+                    queued=self.num_queued,
+                    running_costly=self.num_costly)
+
+    def put(self, channel: Hashable, message, prediction: IntentPrediction) -> bool:
+        # Returns false if the message was dropped.
+        self._start()
+        self.received += 1
+        job = IngestJob(message, prediction, next(self.seq), time.perf_counter())
+        jobs = self.channels.setdefault(channel, [])
+        if self.coalesce and job.cost > 0:
+            for idx, queued in enumerate(jobs):
+                if queued.prediction.intent is prediction.intent and queued.message.author_name == message.author_name:
+                    jobs[idx] = IngestJob(message, prediction, queued.seq, job.enqueued)
+                    self.coalesced += 1
+                    self._notify_drop(queued)
+                    return True
+        if len(jobs) >= self.channel_queue_size:
+            victim = min(jobs, key=lambda x: (-x.cost, x.seq))
+            self.dropped += 1
+            if victim.cost < job.cost:
+                self._log_drop(job)
+                return False
+            jobs.remove(victim)
+            self._log_drop(victim)
+        jobs.append(job)
+        self.job_ready.set()
+        return True
+
+    def _log_drop(self, job: IngestJob):
+        print(f'Dropped {job.prediction.intent.fq_name} for {job.message.author_name} ({self.dropped} total)')
+        self._notify_drop(job)
+
+    def _notify_drop(self, job: IngestJob):
+        for listener in self.drop_listeners:
+            listener(job)
+
+    def _start(self):
+        if self.workers:
+            return
+        self.job_ready = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        self.workers = [loop.create_task(self._work()) for _ in range(self.num_workers)]
+
+    def _next_job(self) -> Optional[IngestJob]:
+        allow_costly = self.num_costly < self.max_costly_workers
+        best = None  # type: Optional[IngestJob]
+        best_channel = None
+        for channel, jobs in self.channels.items():
+            for job in jobs:
+                if job.cost > 0 and not allow_costly:
+                    continue
+                if best is None or (job.cost, job.seq) < (best.cost, best.seq):
+                    best, best_channel = job, channel
+        if best is not None:
+            jobs = self.channels[best_channel]
+            jobs.remove(best)
+            if not jobs:
+                del self.channels[best_channel]
+        return best
+
+    async def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self.job_ready.clear()
+                await self.job_ready.wait()
+                continue
+            costly = job.cost > 0
+            if costly:
+                self.num_costly += 1
+            self.num_running += 1
+            METRICS.histogram('lex_queue_wait_seconds', intent=job.prediction.intent.fq_name)\
+                .observe(time.perf_counter() - job.enqueued)
+            try:
+                await job.prediction.intent.handle(job.message, job.prediction.data)
+                self.handled += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
+            finally:
+                self.num_running -= 1
+                for listener in self.listeners:
+                    listener(job, time.perf_counter() - job.enqueued)
+                if costly:
+                    self.num_costly -= 1
+                    self.job_ready.set()  # a worker held back from costly jobs may take one now
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
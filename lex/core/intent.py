@@ -1,10 +1,15 @@
 from dataclasses import dataclass, field
-from typing import List, Coroutine, Iterable, Dict, Any, Pattern
+from typing import List, Coroutine, Iterable, Dict, Any, Pattern, TYPE_CHECKING
 import abc
-import re
+import threading
 
+from lex.utils.metrics import timed
+from lex.utils.regex import RegexIndex
 import lex.utils.message as msg_utils
 
+if TYPE_CHECKING:
+    from lex.utils.embedding import EmbeddingIndex
+
 
 HandlerType = Coroutine
 
@@ -12,10 +17,17 @@ HandlerType = Coroutine
 class IntentRegistry:
     def __init__(self):
         self.intent_map = {}
+        self.lock = threading.RLock()  # hold it to swap several intents at once
 
     def register(self, intent: 'Intent'):
-        assert intent.fq_name not in self.intent_map, 'Intent with FQ name already exists.'
-        self.intent_map[intent.fq_name] = intent
+        with self.lock:
+            assert intent.fq_name not in self.intent_map, 'Intent with FQ name already exists.'
+            self.intent_map[intent.fq_name] = intent
+
+    def unregister(self, intent: 'Intent'):
+        with self.lock:
+            if self.intent_map.get(intent.fq_name) is intent:
+                del self.intent_map[intent.fq_name]
 
     def intents(self) -> Iterable['Intent']:
         return self.intent_map.values()
@@ -33,16 +45,20 @@ class IntentRegistry:
 class Intent:
     namespace: str = ''
 
-    def __init__(self, name: str = ''):
+    def __init__(self, name: str = '', cost: int = 0):
         self.handlers = []  # type: List[HandlerType]
         self.name = name
+        # Handling cost: costly intents are rate limited by this many tokens, and under load cheaper intents are
+        # handled first and costly ones shed first.
+        self.cost = cost
 
     def register_handler(self, handler: HandlerType):
         self.handlers.append(handler)
 
     async def handle(self, message, data):
-        for handler in self.handlers:
-            await handler(message, data)
+        with timed('lex_handle_seconds', intent=self.fq_name):
+            for handler in self.handlers:
+                await handler(message, data)
 
     @property
     def fq_name(self):
@@ -60,6 +76,16 @@ class IntentPrediction:
 
 
 class IntentPredictor:
+    cost = 0  # evaluation cost tier; cheaper tiers are evaluated first
+    max_rel = 1.0  # no prediction of this predictor is ever more relevant
+
+    def observe(self, message):
+        # Called for every message, even when predict() is skipped.
+        pass
+
+    def upper_bound(self, message) -> float:
+        return self.max_rel
+
     def predict(self, message) -> List[IntentPrediction]:
         return self.on_predict(message)
 
@@ -69,6 +95,11 @@ class IntentPredictor:
 
 
 class IntentSelfMentionFilterMixin:
+    def upper_bound(self, message) -> float:
+        if not message.attributes.get('self-mention'):
+            return 0
+        return super().upper_bound(message)
+
     def predict(self, message) -> List[IntentPrediction]:
         if not message.attributes.get('self-mention'):
             return [IntentPrediction(0, NULL_INTENT)]
@@ -79,6 +110,7 @@ class ConstantIntentPredictor(IntentPredictor):
     def __init__(self, intent: Intent, value: float):
         self.intent = intent
         self.value = value
+        self.max_rel = value
 
     def on_predict(self, message) -> List[IntentPrediction]:
         return [IntentPrediction(self.value, self.intent)]
@@ -89,38 +121,61 @@ class ConstantSelfMentionPredictor(IntentSelfMentionFilterMixin, ConstantIntentP
         super().__init__(*args)
 
 
-class LemmaRegexIntentPredictor(IntentPredictor):
-    def __init__(self, regex_intent_map: Dict[re.Pattern, Intent]):
-        self.regex_intent_map = regex_intent_map
+class RegexIntentPredictor(IntentPredictor):
+    cost = 1
+
+    def __init__(self, regex_intent_map: Dict[Pattern[str], Intent]):
+        self.intents = list(regex_intent_map.values())
+        self.matcher = RegexIndex(list(regex_intent_map.keys()))
+
+    @classmethod
+    def from_index(cls, matcher: RegexIndex, intents: List[Intent]):
+        # Predicts intents[idx] for the matcher's idx-th pattern, e.g. from an unpickled index that compiles lazily
+        predictor = cls({})
+        predictor.matcher = matcher
+        predictor.intents = intents
+        return predictor
+
+    def predict_text(self, text: str) -> List[IntentPrediction]:
+        match = self.matcher.match(text)
+        if match is None:
+            return [IntentPrediction(0, NULL_INTENT)]
+        idx, groups, groupdict = match
+        return [IntentPrediction(1, self.intents[idx], dict(groups=groups, groupdict=groupdict))]
 
     def on_predict(self, message) -> List[IntentPrediction]:
-        doc = msg_utils.nlp(message.message_content)
-        lemmatized = ' '.join([word.lemma for sent in doc.sentences for word in sent.words])
-        preds = []
-        for rgx, intent in self.regex_intent_map.items():
-            m = rgx.match(lemmatized)
-            pred = IntentPrediction(int(m is not None), intent)
-            if m is not None:
-                pred.data['groups'] = m.groups()
-                pred.data['groupdict'] = m.groupdict()
-            preds.append(pred)
-        return preds
+        return self.predict_text(message.message_content)
 
 
-class RegexIntentPredictor(IntentPredictor):
-    def __init__(self, regex_intent_map: Dict[Pattern[str], Intent]):
-        self.regex_intent_map = regex_intent_map
+class LemmaRegexIntentPredictor(RegexIntentPredictor):
+    cost = 2
 
     def on_predict(self, message) -> List[IntentPrediction]:
-        preds = []
-        for rgx, intent in self.regex_intent_map.items():
-            m = rgx.match(message.message_content)
-            pred = IntentPrediction(int(m is not None), intent)
-            if m is not None:
-                pred.data['groups'] = m.groups()
-            preds.append(pred)
-        return preds
+        return self.predict_text(msg_utils.lemmatize(message.message_content))
+
+
+class EmbeddingIntentPredictor(IntentPredictor):
+    # Fuzzy matching against example texts: predicts the intent of the most similar example, with a rel of
+    # `max_rel` times its cosine similarity, if that similarity reaches `threshold`.
+    cost = 1
+
+    def __init__(self, index: 'EmbeddingIndex', intents: List[Intent], threshold: float = 0.4, max_rel: float = 0.9):
+        self.index = index
+        self.intents = intents
+        self.threshold = threshold
+        self.max_rel = max_rel
+
+    def on_predict(self, message) -> List[IntentPrediction]:
+        top = self.index.top_k(message.message_content, 1)
+        if not top or top[0][1] < self.threshold:
+            return [IntentPrediction(0, NULL_INTENT)]
+        idx, similarity = top[0][0], min(top[0][1], 1.0)
+        return [IntentPrediction(self.max_rel * similarity, self.intents[idx], dict(similarity=similarity))]
 
 
 class MentionedRegexIntentPredictor(IntentSelfMentionFilterMixin, RegexIntentPredictor):
     pass
+
+
+class MentionedEmbeddingIntentPredictor(IntentSelfMentionFilterMixin, EmbeddingIntentPredictor):
+    pass
@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List, Tuple
+import time
+
+from lex.utils.cache import ExpiringLruCache
+
+
+__all__ = ['RateLimit', 'TokenBucket', 'RateLimiter']
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    interval: float  # seconds to earn one token back; zero or less disables the limit
+    burst: float = 1
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    @property
+    def refill_time(self) -> float:
+        # An untouched bucket is full again after this long, so forgetting it earlier changes nothing.
+        return self.interval * self.burst
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, limit: RateLimit, now: float):
+        self.tokens = limit.burst
+        self.stamp = now
+
+    def refill(self, limit: RateLimit, now: float):
+        self.tokens = min(limit.burst, self.tokens + (now - self.stamp) / limit.interval)
+        self.stamp = now
+
+    def wait_time(self, limit: RateLimit, cost: float) -> float:
+        return max(0.0, (cost - self.tokens) * limit.interval)
+
+
+class RateLimiter:
+    # Token buckets per author, per channel and overall. A request takes `cost` tokens from all three or from none.
+    # `author_overrides` replaces the author limit in the named channels. Per-key buckets live in LRU caches that
+    # forget a bucket once it would have refilled, which bounds memory to the keys active in the last refill period
+    # (and to `max_keys` at worst).
+
+    def __init__(self,
+                 author: RateLimit,
+                 channel: RateLimit,
+                 overall: RateLimit,
+                 author_overrides: Dict[str, RateLimit] = None,
+                 max_keys: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.author = author
+        self.channel = channel
+        self.overall = overall
+        self.author_overrides = author_overrides or {}
+        self.clock = clock
+        self.max_keys = max_keys
+        self.author_buckets = self._make_cache(author, *self.author_overrides.values())
+        self.channel_buckets = self._make_cache(channel)
+        self.overall_bucket = TokenBucket(overall, clock())
+        self.allowed = 0
+        self.limited = 0
+
+    def _make_cache(self, *limits: RateLimit) -> ExpiringLruCache:
+        ttl = max(0, max(x.refill_time for x in limits))
+        return ExpiringLruCache(maxsize=self.max_keys, ttl=ttl, clock=self.clock)
+
+    def _bucket(self, cache: ExpiringLruCache, key: Hashable, limit: RateLimit, now: float) -> TokenBucket:
+        bucket = cache.get_or_create(key, lambda: TokenBucket(limit, now))
+        bucket.refill(limit, now)
+        return bucket
+
+    def acquire(self,
+                author: Hashable,
+                channel: Hashable,
+                cost: float = 1,
+                channel_name: str = None) -> float:
+        # Returns zero and takes the tokens if the request is allowed, or else the seconds until it would be.
+        if cost <= 0:
+            return 0.0
+        now = self.clock()
+        author_limit = self.author_limit(channel_name)
+        checks = []  # type: List[Tuple[TokenBucket, RateLimit]]
+        if author_limit.enabled:
+            checks.append((self._bucket(self.author_buckets, author, author_limit, now), author_limit))
+        if self.channel.enabled:
+            checks.append((self._bucket(self.channel_buckets, channel, self.channel, now), self.channel))
+        if self.overall.enabled:
+            self.overall_bucket.refill(self.overall, now)
+            checks.append((self.overall_bucket, self.overall))
+        wait = max((bucket.wait_time(limit, cost) for bucket, limit in checks), default=0.0)
+        if wait > 0:
+            self.limited += 1
+            return wait
+        for bucket, _ in checks:
+            bucket.tokens -= cost
+        self.allowed += 1
+        return 0.0
+
+    def release(self, author: Hashable, channel: Hashable, cost: float = 1, channel_name: str = None):
+        # Gives back the tokens of an acquired request that never ran, e.g. one the ingestion queue dropped.
+        if cost <= 0:
+            return
+        now = self.clock()
+        author_limit = self.author_limit(channel_name)
+        returns = []  # type: List[Tuple[TokenBucket, RateLimit]]
+        if author_limit.enabled:
+            returns.append((self._bucket(self.author_buckets, author, author_limit, now), author_limit))
+        if self.channel.enabled:
+            returns.append((self._bucket(self.channel_buckets, channel, self.channel, now), self.channel))
+        if self.overall.enabled:
+            self.overall_bucket.refill(self.overall, now)
+            returns.append((self.overall_bucket, self.overall))
+        for bucket, limit in returns:
+            bucket.tokens = min(limit.burst, bucket.tokens + cost)
+
+    def author_limit(self, channel_name: str = None) -> RateLimit:
+        return self.author_overrides.get(channel_name, self.author)
@@ -1,3 +1,5 @@
+from typing import Dict, Optional
+
 from pydantic import BaseSettings
 
 
@@ -8,3 +10,22 @@ class BotSettings(BaseSettings):
     api_token: str
     mention_workaround: str = '<@​&723317393870422146>'
     preset_name: str = ''
+    offline: bool = False
+    warmup: bool = True
+    ingest_workers: int = 4
+    ingest_costly_workers: int = 2
+    ingest_queue_size: int = 16
+    ingest_coalesce: bool = True
+    rate_author_interval: float = 5  # seconds per unit of intent cost; zero disables a limit
+    rate_author_burst: float = 1
+    rate_author_intervals: Dict[str, float] = {}  # author interval by channel name
+    sample_cooldown: Optional[float] = None  # deprecated name of rate_author_interval, which it overrides when set
+    cooldowns: Dict[str, float] = {}  # deprecated name of rate_author_intervals
+    rate_channel_interval: float = 1
+    rate_channel_burst: float = 5
+    rate_global_interval: float = 0.25
+    rate_global_burst: float = 10
+    rate_max_keys: int = 10000
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 0  # serves Prometheus text at /metrics when set
+    metrics_log_interval: float = 0  # prints a summary every this many seconds when set
@@ -0,0 +1,69 @@
+from typing import Callable, Optional
+import asyncio
+import time
+
+import discord as disc
+
+
+__all__ = ['StreamingReply']
+
+
+class StreamingReply:
+    # Posts a message as soon as there is text to show, then edits it as the text grows. Edits are coalesced so
+    # that at most one goes out per `min_interval` seconds, which keeps a reply under Discord's edit rate limit.
+    def __init__(self,
+                 channel: disc.abc.Messageable,
+                 prefix: str = '',
+                 transform: Callable[[str], str] = None,
+                 min_interval: float = 1.0):
+        self.channel = channel
+        self.prefix = prefix
+        self.transform = transform
+        self.min_interval = min_interval
+        self.message = None  # type: Optional[disc.Message]
+        self.text = ''
+        self.sent_text = ''
+        self.last_send = 0.0
+        self.flush_task = None  # type: Optional[asyncio.Task]
+        self.send_lock = asyncio.Lock()
+
+    @property
+    def content(self) -> str:
+        text = self.prefix + self.text
+        return self.transform(text) if self.transform is not None else text
+
+    async def update(self, text: str):
+        self.text = text
+        if self.flush_task is not None or not self.content.strip():
+            return
+        delay = self.last_send + self.min_interval - time.time()
+        if delay <= 0:
+            await self.flush()
+        else:
+            self.flush_task = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.send_lock:
+            content = self.content
+            if content == self.sent_text or not content.strip():
+                return
+            self.sent_text = content
+            self.last_send = time.time()
+            if self.message is None:
+                self.message = await self.channel.send(content)
+            else:
+                await self.message.edit(content=content)
+
+    async def finish(self, text: str = None) -> Optional[disc.Message]:
+        if text is not None:
+            self.text = text
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        return self.message
@@ -0,0 +1,5 @@
+from .executor import *
+from .batching import *
+from .registry import *
+from .pool import *
+from .remote import *
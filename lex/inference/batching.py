@@ -0,0 +1,149 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Deque, Any, Callable, Optional, Set
+import asyncio
+
+from .executor import InferenceExecutor, InferenceQueueFullError
+from lex.utils.metrics import METRICS, timed
+
+
+__all__ = ['BatchingScheduler', 'GenerationRequest']
+
+
+@dataclass
+class GenerationRequest:
+    prompt_ids: List[int]
+    max_length: int
+    eos_token_id: int
+    min_length: int
+    num_return_sequences: int
+    prefix_cache: Any
+    on_token: Optional[Callable[[int], None]]
+    future: asyncio.Future
+
+
+class BatchingScheduler:
+    # Collects generation requests that arrive within `batch_window` seconds (or until `max_batch_size` rows are
+    # waiting) and runs them as a single left-padded sampling call on the executor, with up to one batch per executor
+    # worker running at a time. A request asking for several return sequences takes that many rows of the batch.
+
+    def __init__(self,
+                 model,
+                 executor: InferenceExecutor,
+                 max_batch_size: int = 8,
+                 batch_window: float = 0.02,
+                 max_pending: int = 32,
+                 **sampling_kwargs):
+        self.model = model
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.sampling_kwargs = sampling_kwargs
+        self.pending = deque()  # type: Deque[GenerationRequest]
+        self.batch_ready = None  # type: asyncio.Event
+        self.dispatch_task = None  # type: asyncio.Task
+        self.running = set()  # type: Set[asyncio.Task]  # batches on the executor
+
+    @property
+    def is_idle(self) -> bool:
+        return not self.pending and not self.running and (self.dispatch_task is None or self.dispatch_task.done())
+
+    @property
+    def num_pending_rows(self) -> int:
+        return sum(x.num_return_sequences for x in self.pending)
+
+    def new_prefix_cache(self):
+        from .sampling import PrefixCache
+        return PrefixCache()
+
+    async def generate(self,
+                       prompt_ids: List[int],
+                       max_length: int,
+                       eos_token_id: int,
+                       min_length: int = 0,
+                       num_return_sequences: int = 1,
+                       prefix_cache=None,
+                       on_token: Callable[[int], None] = None) -> List[List[int]]:
+        # `on_token` is called on the event loop with every token sampled for the request, as it is sampled.
+        if len(self.pending) >= self.max_pending:
+            raise InferenceQueueFullError(f'{len(self.pending)} generation requests already pending')
+        loop = asyncio.get_event_loop()
+        request = GenerationRequest(list(prompt_ids),
+                                    max_length,
+                                    eos_token_id,
+                                    min_length,
+                                    min(num_return_sequences, self.max_batch_size),
+                                    prefix_cache,
+                                    on_token,
+                                    loop.create_future())
+        self.pending.append(request)
+        if self.batch_ready is None:
+            self.batch_ready = asyncio.Event()
+        if self.num_pending_rows >= self.max_batch_size:
+            self.batch_ready.set()
+        if self.dispatch_task is None or self.dispatch_task.done():
+            self.dispatch_task = loop.create_task(self._dispatch())
+        with timed('lex_generate_seconds'):
+            return await request.future
+
+    async def _dispatch(self):
+        # Keeps up to one batch per executor worker in flight. While every worker is busy, requests keep queueing,
+        # so the next batch goes out fuller.
+        while self.pending:
+            if len(self.running) >= self.executor.num_workers:
+                await asyncio.wait(self.running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            if self.num_pending_rows < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+            self.batch_ready.clear()
+            batch = []
+            num_rows = 0
+            while self.pending and num_rows + self.pending[0].num_return_sequences <= self.max_batch_size:
+                request = self.pending.popleft()
+                if not request.future.done():
+                    batch.append(request)
+                    num_rows += request.num_return_sequences
+            if not batch:
+                continue
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run_batch(self, batch: List[GenerationRequest]):
+        from .sampling import sample_batch
+        rows = [x for x in batch for _ in range(x.num_return_sequences)]
+        on_token = None
+        if any(x.on_token is not None for x in rows):
+            loop = asyncio.get_event_loop()
+            row_callbacks = [x.on_token for x in rows]
+
+            def on_token(row, token):
+                if row_callbacks[row] is not None:
+                    loop.call_soon_threadsafe(row_callbacks[row], token)
+        METRICS.histogram('lex_batch_rows', buckets=(1, 2, 4, 8, 16, 32, 64)).observe(len(rows))
+        try:
+            with timed('lex_batch_seconds'):
+                outputs = await self.executor.submit(sample_batch,
+                                                     self.model,
+                                                     [x.prompt_ids for x in rows],
+                                                     [x.max_length for x in rows],
+                                                     [x.eos_token_id for x in rows],
+                                                     min_lengths=[x.min_length for x in rows],
+                                                     prefix_caches=[x.prefix_cache for x in rows],
+                                                     on_token=on_token,
+                                                     **self.sampling_kwargs)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        METRICS.counter('lex_generated_tokens_total').inc(sum(len(x) for x in outputs))
+        offset = 0
+        for request in batch:
+            if not request.future.done():
+                request.future.set_result(outputs[offset:offset + request.num_return_sequences])
+            offset += request.num_return_sequences
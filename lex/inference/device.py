@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+
+from torch import nn
+from transformers.modeling_utils import Conv1D
+import torch
+
+
+__all__ = ['prepare_model', 'quantize_model', 'inference_context']
+
+
+@contextmanager
+def inference_context():
+    ctx = torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+    with ctx:
+        yield
+
+
+def _conv1d_to_linear(conv: Conv1D) -> nn.Linear:
+    # GPT-2's Conv1D computes x @ W + b with W of shape (in, out); nn.Linear stores the transpose.
+    in_features, out_features = conv.weight.shape
+    linear = nn.Linear(in_features, out_features)
+    linear.weight.data = conv.weight.data.t().contiguous()
+    linear.bias.data = conv.bias.data
+    return linear
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    # Dynamic quantization only targets nn.Linear, so the Conv1D projections are converted first. Quantizes in place,
+    # since a copy of the fp32 weights would double peak memory.
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                setattr(module, name, _conv1d_to_linear(child))
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def prepare_model(model: nn.Module, device: str = 'cuda', quantize: bool = False, num_threads: int = 0) -> nn.Module:
+    device = torch.device(device)
+    model.eval()
+    if device.type == 'cpu':
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if quantize:
+            model = quantize_model(model)
+        return model
+    return model.to(device)
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+import asyncio
+
+
+__all__ = ['InferenceExecutor', 'InferenceQueueFullError']
+
+
+T = TypeVar('T')
+
+
+class InferenceQueueFullError(Exception):
+    pass
+
+
+class InferenceExecutor:
+    # Runs blocking model calls on worker threads; at most `max_queue_size` jobs wait behind the running ones.
+    def __init__(self, num_workers: int = 1, max_queue_size: int = 8, name: str = 'inference'):
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.pool = ThreadPoolExecutor(num_workers, thread_name_prefix=name)
+        self.num_pending = 0  # only touched from the event loop thread
+
+    @property
+    def is_full(self) -> bool:
+        return self.num_pending >= self.num_workers + self.max_queue_size
+
+    @property
+    def is_idle(self) -> bool:
+        return self.num_pending == 0
+
+    async def submit(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        if self.is_full:
+            raise InferenceQueueFullError(f'{self.num_pending} inference jobs already pending')
+        loop = asyncio.get_event_loop()
+        self.num_pending += 1
+        try:
+            return await loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+        finally:
+            self.num_pending -= 1
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
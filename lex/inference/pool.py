@@ -0,0 +1,153 @@
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+
+from .executor import InferenceQueueFullError
+from lex.utils.metrics import METRICS
+
+
+__all__ = ['SamplePool']
+
+
+class SamplePool:
+    # Samples generated ahead of time for the most requested prompts, while the model has nothing else to do. A
+    # request pops a pooled sample if there is one, and the refill task replaces it the next time the model is idle.
+    # Request counts decay by half every `half_life` requests, so the pool follows whoever is being sampled lately.
+
+    def __init__(self,
+                 generate: Callable[[str], Awaitable[str]],
+                 is_idle: Callable[[], bool],
+                 pool_size: int = 2,
+                 max_prompts: int = 12,
+                 min_requests: float = 2,
+                 max_bytes: int = 65536,
+                 max_tracked: int = 1000,
+                 half_life: int = 200,
+                 interval: float = 1.0):
+        self.generate = generate
+        self.is_idle = is_idle
+        self.pool_size = pool_size
+        self.max_prompts = max_prompts
+        self.min_requests = min_requests
+        self.max_bytes = max_bytes
+        self.max_tracked = max_tracked
+        self.interval = interval
+        self.decay = 2 ** (1 / half_life)
+        self.weight = 1.0  # what a request adds to its prompt's count; grows instead of decaying every count
+        self.counts = {}  # type: Dict[str, float]
+        self.samples = {}  # type: Dict[str, Deque[str]]
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.evicted = 0
+        self.task = None  # type: Optional[asyncio.Task]
+        self.wakeup = None  # type: Optional[asyncio.Event]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return dict(hits=self.hits, misses=self.misses, hit_rate=round(self.hit_rate, 3), generated=self.generated,
+                    evicted=self.evicted, pooled=sum(len(x) for x in self.samples.values()), bytes=self.num_bytes)
+
+    def start(self):
+        # Must be called from the event loop; safe to call on every request.
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self._refill())
+
+    def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def pop(self, prompt: str) -> Optional[str]:
+        self._count(prompt)
+        samples = self.samples.get(prompt)
+        if not samples:
+            self.misses += 1
+            METRICS.counter('lex_sample_pool_requests_total', result='miss').inc()
+            return None
+        text = samples.popleft()
+        self.num_bytes -= len(text.encode('utf-8'))
+        if not samples:
+            del self.samples[prompt]
+        self.hits += 1
+        METRICS.counter('lex_sample_pool_requests_total', result='hit').inc()
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return text
+
+    def _count(self, prompt: str):
+        self.weight *= self.decay
+        if self.weight > 1e6:  # rescale before the counts lose precision
+            self.counts = {k: v / self.weight for k, v in self.counts.items()}
+            self.weight = 1.0
+        self.counts[prompt] = self.counts.get(prompt, 0.0) + self.weight
+        if len(self.counts) > self.max_tracked:
+            # Forgets the colder half of the prompts, and any samples pooled for them
+            keep = sorted(self.counts, key=self.counts.get, reverse=True)[:self.max_tracked // 2]
+            self.counts = {k: self.counts[k] for k in keep}
+            for cold in [x for x in self.samples if x not in self.counts]:
+                self._evict(cold)
+
+    def _evict(self, prompt: str):
+        for text in self.samples.pop(prompt, ()):
+            self.num_bytes -= len(text.encode('utf-8'))
+            self.evicted += 1
+
+    def hot_prompts(self) -> List[str]:
+        threshold = self.min_requests * self.weight
+        prompts = sorted((x for x, count in self.counts.items() if count >= threshold), key=self.counts.get, reverse=True)
+        return prompts[:self.max_prompts]
+
+    def next_prompt(self) -> Optional[str]:
+        # The hot prompt with the fewest pooled samples, the most requested one first among equals
+        prompts = [x for x in self.hot_prompts() if len(self.samples.get(x, ())) < self.pool_size]
+        if not prompts:
+            return None
+        return min(prompts, key=lambda x: len(self.samples.get(x, ())))
+
+    def _add(self, prompt: str, text: str) -> bool:
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return False
+        hot = set(self.hot_prompts())
+        for cold in sorted(self.samples, key=lambda x: self.counts.get(x, 0.0)):
+            if self.num_bytes + size <= self.max_bytes:
+                break
+            if cold in hot and self.counts.get(cold, 0.0) >= self.counts.get(prompt, 0.0):
+                return False
+            self._evict(cold)
+        if self.num_bytes + size > self.max_bytes:
+            return False
+        self.samples.setdefault(prompt, deque()).append(text)
+        self.num_bytes += size
+        self.generated += 1
+        return True
+
+    async def _refill(self):
+        while True:
+            prompt = self.next_prompt() if self.is_idle() else None
+            if prompt is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                text = await self.generate(prompt)
+            except asyncio.CancelledError:
+                raise
+            except InferenceQueueFullError:
+                await asyncio.sleep(self.interval)
+                continue
+            except Exception as e:
+                print(f'Could not pre-generate a sample for {prompt!r}: {e!r}')
+                await asyncio.sleep(self.interval)
+                continue
+            self._add(prompt, text)
@@ -0,0 +1,82 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple, TYPE_CHECKING
+import threading
+
+if TYPE_CHECKING:
+    from torch import nn
+    from transformers import GPT2Tokenizer
+
+
+__all__ = ['ModelRegistry']
+
+
+ModelKey = Tuple[str, str, str, bool]
+
+
+class ModelRegistry:
+    # Hands out one shared model per (base model, fine-tuned weights, device, quantization). Fine-tunes of the same
+    # base share every parameter tensor that the fine-tuning left untouched, so memory grows with distinct weights.
+    # torch and transformers are only imported once the first model is requested.
+
+    def __init__(self):
+        self.models = {}  # type: Dict[ModelKey, nn.Module]
+        self.tokenizers = {}  # type: Dict[str, GPT2Tokenizer]
+        self.shared_params = defaultdict(lambda: defaultdict(list))  # type: Dict[Tuple, Dict[str, List[nn.Parameter]]]
+        self.lock = threading.RLock()
+        self.local_files_only = False
+
+    def tokenizer(self, base_model: str) -> 'GPT2Tokenizer':
+        from transformers import GPT2Tokenizer
+        with self.lock:
+            if base_model not in self.tokenizers:
+                self.tokenizers[base_model] = GPT2Tokenizer.from_pretrained(base_model,
+                                                                            local_files_only=self.local_files_only)
+            return self.tokenizers[base_model]
+
+    def model(self,
+              base_model: str,
+              weights_path: str = None,
+              device: str = 'cuda',
+              quantize: bool = False,
+              num_threads: int = 0) -> 'nn.Module':
+        from transformers import GPT2LMHeadModel
+        import torch
+        from .device import prepare_model
+        from .weights import load_finetuned
+        quantize = quantize and torch.device(device).type == 'cpu'
+        key = (base_model, weights_path or '', str(torch.device(device)), quantize)
+        with self.lock:
+            if key not in self.models:
+                if weights_path:
+                    model = load_finetuned(base_model, weights_path, local_files_only=self.local_files_only)
+                else:
+                    model = GPT2LMHeadModel.from_pretrained(base_model, local_files_only=self.local_files_only)
+                model = prepare_model(model, device=device, quantize=quantize, num_threads=num_threads)
+                self._share_parameters(model, (base_model,) + key[2:])
+                self.models[key] = model
+            return self.models[key]
+
+    def _share_parameters(self, model: 'nn.Module', group: Tuple):
+        import torch
+        shared_params = self.shared_params[group]
+        modules = dict(model.named_modules())
+        num_shared = 0
+        for name, param in list(model.named_parameters()):
+            for other in shared_params[name]:
+                if other.shape == param.shape and torch.equal(other.data, param.data):
+                    module_name, _, attr_name = name.rpartition('.')
+                    setattr(modules[module_name], attr_name, other)
+                    num_shared += param.numel()
+                    break
+            else:
+                shared_params[name].append(param)
+        if not group[-1]:  # quantized output layers are no longer tied to the input embeddings
+            model.tie_weights()
+        if num_shared:
+            print(f'Sharing {num_shared} parameters with previously loaded {group[0]} models')
+
+    @staticmethod
+    def instance() -> 'ModelRegistry':
+        if not hasattr(ModelRegistry, '_instance'):
+            ModelRegistry._instance = ModelRegistry()
+        return ModelRegistry._instance
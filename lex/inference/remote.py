@@ -0,0 +1,295 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import itertools
+import json
+import socket
+import struct
+import threading
+import uuid
+
+from .executor import InferenceQueueFullError
+
+
+__all__ = ['InferenceServerError', 'InferenceClient', 'RemoteScheduler', 'RemotePrefixCache', 'RemoteLemmatizer',
+           'parse_address']
+
+
+# Every frame is one JSON object preceded by its length as a 4-byte big-endian integer. Requests carry an `id` and
+# an `op`; the server answers with any number of `token` frames and then one `result` or `error` frame per id.
+HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 2 ** 20
+
+
+class InferenceServerError(Exception):
+    pass
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    # 'unix:/run/lex.sock' or a bare absolute path for a Unix socket, 'host:port' for TCP
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    if address.startswith('/'):
+        return 'unix', address
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def encode_frame(message: Dict) -> bytes:
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict:
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise InferenceServerError(f'Frame of {size} bytes exceeds the limit')
+    return json.loads((await reader.readexactly(size)).decode('utf-8'))
+
+
+def raise_error(frame: Dict):
+    if frame.get('kind') == 'queue_full':
+        raise InferenceQueueFullError(frame['error'])
+    raise InferenceServerError(frame['error'])
+
+
+class _Connection:
+    # One stream to the server with any number of requests in flight; a reader task routes the frames it receives
+    # to the queue of their request.
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.waiting = {}  # type: Dict[int, asyncio.Queue]
+        self.closed = False
+        self.read_task = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                queue = self.waiting.get(frame.get('id'))
+                if queue is not None:
+                    queue.put_nowait(frame)
+        except (asyncio.IncompleteReadError, ConnectionError, InferenceServerError, ValueError) as e:
+            error = f'Connection to the inference server lost: {e!r}'
+        except asyncio.CancelledError:
+            error = 'Connection to the inference server closed'
+        self.closed = True
+        for request_id, queue in self.waiting.items():
+            queue.put_nowait(dict(id=request_id, error=error))
+        self.writer.close()
+
+    def close(self):
+        self.read_task.cancel()
+
+
+class InferenceClient:
+    # Calls an inference server over a small pool of connections. A request goes to the least busy connection, and a
+    # new connection is opened while every open one is busy and the pool isn't full. `timeout` bounds a whole request,
+    # including the time it waits in the server's queue.
+
+    def __init__(self, address: str, pool_size: int = 4, timeout: float = 60.0, connect_timeout: float = 5.0):
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.connections = []  # type: List[_Connection]
+        self.ids = itertools.count()
+        self.connect_lock = None  # type: Optional[asyncio.Lock]
+
+    async def _connect(self) -> _Connection:
+        kind, target = parse_address(self.address)
+        if kind == 'unix':
+            opening = asyncio.open_unix_connection(target)
+        else:
+            opening = asyncio.open_connection(*target)
+        try:
+            reader, writer = await asyncio.wait_for(opening, self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise InferenceServerError(f'Could not connect to the inference server at {self.address}: {e!r}')
+        return _Connection(reader, writer)
+
+    async def _connection(self) -> _Connection:
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            self.connections = [x for x in self.connections if not x.closed]
+            idle = [x for x in self.connections if not x.waiting]
+            if idle or len(self.connections) >= self.pool_size:
+                return min(self.connections, key=lambda x: len(x.waiting))
+            connection = await self._connect()
+            self.connections.append(connection)
+            return connection
+
+    async def call(self, op: str, on_token: Callable[[int], None] = None, **payload) -> Any:
+        connection = await self._connection()
+        request_id = next(self.ids)
+        queue = asyncio.Queue()
+        connection.waiting[request_id] = queue
+
+        async def receive():
+            while True:
+                frame = await queue.get()
+                if 'token' in frame:
+                    if on_token is not None:
+                        on_token(frame['token'])
+                elif 'error' in frame:
+                    raise_error(frame)
+                else:
+                    return frame.get('result')
+
+        try:
+            connection.writer.write(encode_frame(dict(payload, id=request_id, op=op, stream=on_token is not None)))
+            await connection.writer.drain()
+            return await asyncio.wait_for(receive(), self.timeout)
+        except asyncio.TimeoutError:
+            self._cancel(connection, request_id)
+            raise InferenceServerError(f'{op} timed out after {self.timeout}s')
+        except asyncio.CancelledError:
+            self._cancel(connection, request_id)
+            raise
+        except ConnectionError as e:
+            raise InferenceServerError(f'Connection to the inference server lost: {e!r}')
+        finally:
+            connection.waiting.pop(request_id, None)
+
+    def _cancel(self, connection: _Connection, request_id: int):
+        if not connection.closed:
+            connection.writer.write(encode_frame(dict(id=request_id, op='cancel')))
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    @staticmethod
+    def shared(address: str) -> 'InferenceClient':
+        # One client per server address and process, so modules that use the same server share its connections.
+        if not hasattr(InferenceClient, '_shared'):
+            InferenceClient._shared = {}
+        if address not in InferenceClient._shared:
+            InferenceClient._shared[address] = InferenceClient(address)
+        return InferenceClient._shared[address]
+
+
+class RemotePrefixCache:
+    # Names a prefix cache kept by the server; the keys/values themselves never leave the server process.
+
+    def __init__(self):
+        self.key = uuid.uuid4().hex
+        self.nbytes = 0
+
+    def clear(self):
+        self.key = uuid.uuid4().hex  # the server's entry for the old key expires on its own
+
+
+class RemoteScheduler:
+    # Stands in for a BatchingScheduler whose model lives in an inference server. The server batches the requests
+    # of every connected bot together. `is_idle` and `num_pending_rows` only see this process's requests.
+
+    def __init__(self,
+                 client: InferenceClient,
+                 model: str,
+                 max_batch_size: int = 8,
+                 suppress_token_ids: Sequence[int] = (),
+                 stop_token_ids: Sequence[int] = ()):
+        # `model` names one of the server's `server_models`, which decides the weights, device and draft model.
+        self.client = client
+        self.model = model
+        self.suppress_token_ids = list(suppress_token_ids)
+        self.stop_token_ids = list(stop_token_ids)
+        self.max_batch_size = max_batch_size
+        self.num_pending_rows = 0
+
+    @property
+    def is_idle(self) -> bool:
+        return self.num_pending_rows == 0
+
+    def new_prefix_cache(self) -> RemotePrefixCache:
+        return RemotePrefixCache()
+
+    async def generate(self,
+                       prompt_ids: List[int],
+                       max_length: int,
+                       eos_token_id: int,
+                       min_length: int = 0,
+                       num_return_sequences: int = 1,
+                       prefix_cache: RemotePrefixCache = None,
+                       on_token: Callable[[int], None] = None) -> List[List[int]]:
+        num_rows = min(num_return_sequences, self.max_batch_size)
+        self.num_pending_rows += num_rows
+        try:
+            return await self.client.call('generate',
+                                          on_token=on_token,
+                                          model=self.model,
+                                          suppress_token_ids=self.suppress_token_ids,
+                                          stop_token_ids=self.stop_token_ids,
+                                          prompt_ids=list(prompt_ids),
+                                          max_length=max_length,
+                                          eos_token_id=eos_token_id,
+                                          min_length=min_length,
+                                          num_return_sequences=num_rows,
+                                          prefix_cache=None if prefix_cache is None else prefix_cache.key)
+        finally:
+            self.num_pending_rows -= num_rows
+
+
+class RemoteLemmatizer:
+    # Lemmatizes through an inference server over a blocking socket. The bot prefetches each message's lemmas through
+    # InferenceClient first, so predictors only block here on a cache miss.
+
+    def __init__(self, address: str, timeout: float = 5.0):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None  # type: Optional[socket.socket]
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        kind, target = parse_address(self.address)
+        sock = socket.socket(socket.AF_UNIX if kind == 'unix' else socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(target)
+        except OSError as e:
+            sock.close()
+            raise InferenceServerError(f'Could not connect to the inference server at {self.address}: {e!r}')
+        if kind == 'tcp':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _recv_exactly(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Connection closed by the inference server')
+            data.extend(chunk)
+        return bytes(data)
+
+    def _call(self, op: str, **payload) -> Any:
+        with self.lock:
+            request_id = next(self.ids)
+            try:
+                if self.sock is None:
+                    self.sock = self._connect()
+                self.sock.sendall(encode_frame(dict(payload, id=request_id, op=op)))
+                while True:
+                    size, = HEADER.unpack(self._recv_exactly(HEADER.size))
+                    frame = json.loads(self._recv_exactly(size).decode('utf-8'))
+                    if frame.get('id') == request_id:
+                        break
+            except OSError as e:  # including timeouts; the stream may hold a late answer, so start over
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                raise InferenceServerError(f'{op} failed: {e!r}')
+        if 'error' in frame:
+            raise_error(frame)
+        return frame.get('result')
+
+    def lemmatize(self, text: str) -> str:
+        return self.lemmatize_batch([text])[0]
+
+    def lemmatize_batch(self, texts: Sequence[str]) -> List[str]:
+        return self._call('lemmatize', texts=list(texts))
@@ -0,0 +1,345 @@
+from typing import List, Sequence, Callable, Optional
+
+from torch.nn import functional as F
+import torch
+
+from .device import inference_context
+from lex.utils.metrics import METRICS
+
+__all__ = ['sample_batch', 'speculative_sample_batch', 'filter_logits', 'model_device', 'PrefixCache']
+
+
+def model_device(model) -> torch.device:
+    return next(model.parameters()).device
+
+
+def filter_logits(logits: torch.Tensor, top_k: int = 50, top_p: float = 1.0) -> torch.Tensor:
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth_logits = torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(logits < kth_logits, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_idxs = torch.sort(logits, descending=True)
+        remove_mask = sorted_logits.softmax(-1).cumsum(-1) > top_p
+        remove_mask[..., 1:] = remove_mask[..., :-1].clone()
+        remove_mask[..., 0] = False
+        logits = logits.masked_fill(remove_mask.scatter(-1, sorted_idxs, remove_mask), -float('inf'))
+    return logits
+
+
+class PrefixCache:
+    # Token ids of a prompt together with the model's past key/values for them, so a later prompt that starts the
+    # same way (e.g. the next turn of a conversation) only runs the model over the tokens that differ.
+
+    def __init__(self):
+        self.entry = [], None  # replaced as a whole so concurrent readers see matching ids and keys/values
+        self.reused_tokens = 0
+        self.computed_tokens = 0
+
+    @property
+    def ids(self) -> List[int]:
+        return self.entry[0]
+
+    @property
+    def nbytes(self) -> int:
+        past = self.entry[1]
+        return 0 if past is None else sum(x.numel() * x.element_size() for x in past)
+
+    def clear(self):
+        self.entry = [], None
+
+    def prefill(self, model, prompt: List[int]):
+        cached_ids, cached_past = self.entry
+        reuse = 0
+        if cached_past is not None:
+            for cached_id, prompt_id in zip(cached_ids, prompt[:-1]):  # at least one token runs, for the logits
+                if cached_id != prompt_id:
+                    break
+                reuse += 1
+        past = tuple(layer_past[..., :reuse, :] for layer_past in cached_past) if reuse else None
+        device = model_device(model)
+        input_ids = torch.tensor([prompt[reuse:]], device=device)
+        position_ids = torch.arange(reuse, len(prompt), device=device).unsqueeze(0)
+        logits, past = model(input_ids, past=past, position_ids=position_ids)[:2]
+        self.entry = list(prompt), past
+        self.reused_tokens += reuse
+        self.computed_tokens += len(prompt) - reuse
+        return logits[0, -1], past
+
+
+def _left_pad_past(past, width: int):
+    return tuple(F.pad(layer_past, (0, 0, width - layer_past.size(-2), 0)) for layer_past in past)
+
+
+def _compact_past(past, attention_mask):
+    # Drops masked-out columns from the past and the mask, keeping the rest in order. Rows that keep fewer columns
+    # than the widest are left-padded with some of their masked ones. Positions are passed explicitly, so they don't
+    # depend on the columns.
+    width = attention_mask.size(1)
+    kept = attention_mask.sum(1).max().item()
+    if kept == width:
+        return past, attention_mask
+    columns = torch.arange(width, device=attention_mask.device)
+    idxs = (attention_mask * width + columns).argsort(1)[:, width - kept:]  # masked first, then kept, in order
+    attention_mask = attention_mask.gather(1, idxs)
+    past = tuple(layer_past.gather(-2, idxs[None, :, None, :, None].expand(
+        layer_past.size(0), -1, layer_past.size(2), -1, layer_past.size(-1))) for layer_past in past)
+    return past, attention_mask
+
+
+def _prefill(model, prompts, prefix_caches, pad_token_id):
+    # Returns last-position logits, past key/values, attention mask and the position of the last prompt token
+    # for every row. Uncached prompts run as one left-padded batch; cached ones resume from their prefix cache.
+    device = model_device(model)
+    uncached = [idx for idx, cache in enumerate(prefix_caches) if cache is None]
+    row_logits, row_pasts, row_masks = [None] * len(prompts), [None] * len(prompts), [None] * len(prompts)
+    if uncached:
+        width = max(len(prompts[idx]) for idx in uncached)
+        input_ids = torch.tensor([[pad_token_id] * (width - len(prompts[idx])) + list(prompts[idx])
+                                  for idx in uncached], device=device)
+        attention_mask = torch.tensor([[0] * (width - len(prompts[idx])) + [1] * len(prompts[idx])
+                                       for idx in uncached], device=device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits, past = model(input_ids, past=None, attention_mask=attention_mask, position_ids=position_ids)[:2]
+        if len(uncached) == len(prompts):
+            return logits[:, -1, :], past, attention_mask, position_ids[:, -1:]
+        for row, idx in enumerate(uncached):
+            row_logits[idx] = logits[row, -1]
+            row_pasts[idx] = tuple(layer_past[:, row:row + 1] for layer_past in past)
+            row_masks[idx] = attention_mask[row]
+    for idx, cache in enumerate(prefix_caches):
+        if cache is not None:
+            row_logits[idx], row_pasts[idx] = cache.prefill(model, list(prompts[idx]))
+            row_masks[idx] = torch.ones(len(prompts[idx]), dtype=torch.long, device=device)
+    width = max(x.size(0) for x in row_masks)
+    attention_mask = torch.stack([F.pad(x, (width - x.size(0), 0)) for x in row_masks])
+    past = tuple(torch.cat(layer_pasts, 1) for layer_pasts in zip(*(_left_pad_past(x, width) for x in row_pasts)))
+    return torch.stack(row_logits), past, attention_mask, attention_mask.sum(-1, keepdim=True) - 1
+
+
+def _banned(output: List[int], min_budget: int, eos_token_id: int, suppress_token_ids: Sequence[int],
+            offset: int = 0) -> Sequence[int]:
+    # The token ids a row may not sample `offset` tokens after its current output
+    if len(output) + offset < min_budget:
+        return (eos_token_id,) + tuple(suppress_token_ids)
+    return ()
+
+
+def _next_token_probs(logits: torch.Tensor, banned: Sequence[Sequence[int]], temperature: float, top_k: int,
+                      top_p: float) -> torch.Tensor:
+    for row, token_ids in enumerate(banned):
+        if token_ids:
+            logits[row, list(token_ids)] = -float('inf')
+    return filter_logits(logits / temperature, top_k=top_k, top_p=top_p).softmax(-1)
+
+
+@inference_context()
+def sample_batch(model,
+                 prompts: Sequence[List[int]],
+                 max_lengths: Sequence[int],
+                 eos_token_ids: Sequence[int],
+                 min_lengths: Optional[Sequence[int]] = None,
+                 prefix_caches: Optional[Sequence[Optional[PrefixCache]]] = None,
+                 suppress_token_ids: Sequence[int] = (),
+                 stop_token_ids: Sequence[int] = (),
+                 temperature: float = 1.0,
+                 top_k: int = 50,
+                 top_p: float = 1.0,
+                 pad_token_id: int = 0,
+                 on_token: Optional[Callable[[int, int], None]] = None,
+                 draft_model=None,
+                 num_draft_tokens: int = 4) -> List[List[int]]:
+    # Samples every prompt in one batch until each row emits its EOS or reaches its max length (prompt included,
+    # as with `generate`). `stop_token_ids` end a row like its EOS does. Until a row reaches its min length, its EOS
+    # and `suppress_token_ids` cannot be sampled.
+    # Rows with a prefix cache only run the model over the part of the prompt that isn't cached yet. Finished rows
+    # are dropped from the batch. Returns the new token ids. With a `draft_model`, decodes speculatively instead.
+    if draft_model is not None and num_draft_tokens > 0:
+        return speculative_sample_batch(model, draft_model, prompts, max_lengths, eos_token_ids,
+                                        min_lengths=min_lengths,
+                                        prefix_caches=prefix_caches,
+                                        suppress_token_ids=suppress_token_ids,
+                                        stop_token_ids=stop_token_ids,
+                                        temperature=temperature,
+                                        top_k=top_k,
+                                        top_p=top_p,
+                                        pad_token_id=pad_token_id,
+                                        on_token=on_token,
+                                        num_draft_tokens=num_draft_tokens)
+    device = model_device(model)
+    outputs = [[] for _ in prompts]
+    budgets = [max_length - len(x) for max_length, x in zip(max_lengths, prompts)]
+    min_budgets = [0] * len(prompts) if min_lengths is None else [y - len(x) for y, x in zip(min_lengths, prompts)]
+    active = [idx for idx, budget in enumerate(budgets) if budget > 0]
+    if not active:
+        return outputs
+    prompts = [prompts[idx] for idx in active]
+    prefix_caches = [None] * len(active) if prefix_caches is None else [prefix_caches[idx] for idx in active]
+    logits, past, attention_mask, position_ids = _prefill(model, prompts, prefix_caches, pad_token_id)
+
+    while True:
+        banned = [_banned(outputs[idx], min_budgets[idx], eos_token_ids[idx], suppress_token_ids) for idx in active]
+        next_tokens = torch.multinomial(_next_token_probs(logits, banned, temperature, top_k, top_p), 1)
+        keep = []
+        for row, (idx, token) in enumerate(zip(active, next_tokens.squeeze(1).tolist())):
+            outputs[idx].append(token)
+            if on_token is not None:
+                on_token(idx, token)
+            if token != eos_token_ids[idx] and token not in stop_token_ids and len(outputs[idx]) < budgets[idx]:
+                keep.append(row)
+        if not keep:
+            break
+        if len(keep) < len(active):
+            active = [active[row] for row in keep]
+            keep_idxs = torch.tensor(keep, device=device)
+            next_tokens, attention_mask, position_ids = next_tokens[keep_idxs], attention_mask[keep_idxs], position_ids[keep_idxs]
+            past = tuple(layer_past.index_select(1, keep_idxs) for layer_past in past)
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones(attention_mask.size(0), 1)), 1)
+        position_ids = position_ids + 1
+        logits, past = model(next_tokens, past=past, attention_mask=attention_mask, position_ids=position_ids)[:2]
+        logits = logits[:, -1, :]
+    return outputs
+
+
+@inference_context()
+def speculative_sample_batch(model,
+                             draft_model,
+                             prompts: Sequence[List[int]],
+                             max_lengths: Sequence[int],
+                             eos_token_ids: Sequence[int],
+                             min_lengths: Optional[Sequence[int]] = None,
+                             prefix_caches: Optional[Sequence[Optional[PrefixCache]]] = None,
+                             suppress_token_ids: Sequence[int] = (),
+                             stop_token_ids: Sequence[int] = (),
+                             temperature: float = 1.0,
+                             top_k: int = 50,
+                             top_p: float = 1.0,
+                             pad_token_id: int = 0,
+                             on_token: Optional[Callable[[int, int], None]] = None,
+                             num_draft_tokens: int = 4) -> List[List[int]]:
+    # Same contract and output distribution as sample_batch. Each step, the draft model samples `num_draft_tokens`
+    # tokens one by one and the model scores them all in one forward pass. A draft token is kept with probability
+    # min(1, p / q) under the model's and the draft's filtered distributions. The first rejected one is replaced by a
+    # sample of max(0, p - q); if none is rejected, a token is sampled from p after the last one. Rejected tokens stay
+    # in both models' past, hidden by the attention mask, so rows that kept different numbers of tokens still
+    # share one batch, until they are compacted away. The draft model must share the model's vocabulary; it runs
+    # without prefix caches. A step holds up to `num_draft_tokens` tokens past a row's max length, so fewer are drafted
+    # near the models' context size, and none at all (plain sampling) if the max length leaves no room.
+    if draft_model.config.vocab_size != model.config.vocab_size:
+        raise ValueError(f'Draft vocabulary of {draft_model.config.vocab_size} tokens, expected {model.config.vocab_size}')
+    n_ctx = min(model.config.n_ctx, model.config.n_positions, draft_model.config.n_ctx, draft_model.config.n_positions)
+    k = min(num_draft_tokens, n_ctx + 1 - max(max_lengths, default=0))
+    if k < 1:
+        return sample_batch(model, prompts, max_lengths, eos_token_ids,
+                            min_lengths=min_lengths,
+                            prefix_caches=prefix_caches,
+                            suppress_token_ids=suppress_token_ids,
+                            stop_token_ids=stop_token_ids,
+                            temperature=temperature,
+                            top_k=top_k,
+                            top_p=top_p,
+                            pad_token_id=pad_token_id,
+                            on_token=on_token)
+    device = model_device(model)
+    outputs = [[] for _ in prompts]
+    budgets = [max_length - len(x) for max_length, x in zip(max_lengths, prompts)]
+    min_budgets = [0] * len(prompts) if min_lengths is None else [y - len(x) for y, x in zip(min_lengths, prompts)]
+    active = [idx for idx, budget in enumerate(budgets) if budget > 0]
+    if not active:
+        return outputs
+    prompts = [prompts[idx] for idx in active]
+    prefix_caches = [None] * len(active) if prefix_caches is None else [prefix_caches[idx] for idx in active]
+    logits, past, attention_mask, position_ids = _prefill(model, prompts, prefix_caches, pad_token_id)
+    _, draft_past, draft_mask, _ = _prefill(draft_model, prompts, [None] * len(prompts), pad_token_id)
+    if attention_mask.size(1) != draft_mask.size(1):  # prefix-cached rows aren't padded like the draft's rows
+        draft_mask = F.pad(draft_mask, (attention_mask.size(1) - draft_mask.size(1), 0))
+        draft_past = _left_pad_past(draft_past, attention_mask.size(1))
+
+    def banned(idx, offset=0):
+        return _banned(outputs[idx], min_budgets[idx], eos_token_ids[idx], suppress_token_ids, offset)
+
+    def commit(idx, token) -> bool:
+        # Returns whether the row goes on
+        outputs[idx].append(token)
+        if on_token is not None:
+            on_token(idx, token)
+        return token != eos_token_ids[idx] and token not in stop_token_ids and len(outputs[idx]) < budgets[idx]
+
+    # The first token comes from the prompt's logits; afterwards, the last committed token of every row is pending,
+    # i.e. not yet run through either model.
+    probs = _next_token_probs(logits, [banned(idx) for idx in active], temperature, top_k, top_p)
+    pending = torch.multinomial(probs, 1)
+    keep = [row for row, (idx, token) in enumerate(zip(active, pending.squeeze(1).tolist())) if commit(idx, token)]
+    num_proposed, num_accepted = 0, 0
+    while keep:
+        if len(keep) < len(active):
+            active = [active[row] for row in keep]
+            keep_idxs = torch.tensor(keep, device=device)
+            pending, position_ids = pending[keep_idxs], position_ids[keep_idxs]
+            attention_mask, draft_mask = attention_mask[keep_idxs], draft_mask[keep_idxs]
+            past = tuple(layer_past.index_select(1, keep_idxs) for layer_past in past)
+            draft_past = tuple(layer_past.index_select(1, keep_idxs) for layer_past in draft_past)
+        if (attention_mask.size(1) + k + 1 > n_ctx
+                or attention_mask.size(1) - attention_mask.sum(1).max().item() >= attention_mask.size(1) // 4):
+            past, attention_mask = _compact_past(past, attention_mask)  # rejected tokens and finished rows' columns
+            draft_past, draft_mask = _compact_past(draft_past, draft_mask)
+
+        # The draft runs over the pending token and then each draft token, the last one only to keep its past in
+        # step with the model's.
+        drafts, draft_probs = [], []
+        tokens = pending
+        for offset in range(k + 1):
+            draft_mask = torch.cat((draft_mask, draft_mask.new_ones(draft_mask.size(0), 1)), 1)
+            draft_logits, draft_past = draft_model(tokens, past=draft_past, attention_mask=draft_mask,
+                                                   position_ids=position_ids + offset + 1)[:2]
+            if offset == k:
+                break
+            q = _next_token_probs(draft_logits[:, -1, :], [banned(idx, offset) for idx in active], temperature,
+                                  top_k, top_p)
+            tokens = torch.multinomial(q, 1)
+            drafts.append(tokens)
+            draft_probs.append(q)
+        drafts = torch.cat(drafts, 1)
+        q = torch.stack(draft_probs, 1)
+
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones(attention_mask.size(0), k + 1)), 1)
+        verify_positions = position_ids + torch.arange(1, k + 2, device=device)
+        logits, past = model(torch.cat((pending, drafts), 1), past=past, attention_mask=attention_mask,
+                             position_ids=verify_positions)[:2]
+        p = torch.stack([_next_token_probs(logits[:, offset, :], [banned(idx, offset) for idx in active],
+                                           temperature, top_k, top_p) for offset in range(k + 1)], 1)
+        p_drafts = p[:, :k].gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+        q_drafts = q.gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+        accepted = (torch.rand_like(p_drafts) * q_drafts <= p_drafts).tolist()
+
+        keep, next_pending, num_kept = [], [], []
+        for row, (idx, row_drafts) in enumerate(zip(active, drafts.tolist())):
+            n = 0
+            going = True
+            while going and n < k and accepted[row][n]:
+                going = commit(idx, row_drafts[n])
+                n += 1
+            num_proposed += k
+            num_accepted += n
+            token = pad_token_id
+            if going:
+                if n < k:
+                    residual = (p[row, n] - q[row, n]).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = p[row, n]
+                else:
+                    residual = p[row, k]
+                token = torch.multinomial(residual, 1).item()
+                going = commit(idx, token)
+            if going:
+                keep.append(row)
+            next_pending.append(token)
+            num_kept.append(n)
+            if n < k:  # hides the rejected draft tokens from later steps
+                attention_mask[row, attention_mask.size(1) - k + n:] = 0
+                draft_mask[row, draft_mask.size(1) - k + n:] = 0
+        pending = torch.tensor(next_pending, device=device).unsqueeze(1)
+        position_ids = position_ids + 1 + torch.tensor(num_kept, device=device).unsqueeze(1)
+    METRICS.counter('lex_draft_tokens_total', result='proposed').inc(num_proposed)
+    METRICS.counter('lex_draft_tokens_total', result='accepted').inc(num_accepted)
+    return outputs
@@ -0,0 +1,247 @@
+from typing import Dict
+import argparse
+import asyncio
+import json
+import os
+import socket
+import stat
+import time
+
+from pydantic import BaseModel, BaseSettings
+
+from .batching import BatchingScheduler
+from .executor import InferenceExecutor, InferenceQueueFullError
+from .registry import ModelRegistry
+from .remote import InferenceServerError, encode_frame, parse_address, read_frame
+from lex.utils import message as msg_utils
+from lex.utils.cache import ExpiringLruCache
+
+
+__all__ = ['InferenceServer', 'ServerSettings', 'ServedModel', 'default_server_address']
+
+
+MAX_SCHEDULERS_PER_MODEL = 4  # token id variants of one served model, e.g. different stop tokens
+
+
+def default_server_address() -> str:
+    # A directory only this user can enter; /tmp would let any local user reach the socket.
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    return f'unix:{os.path.join(runtime_dir, "lex") if runtime_dir else "/run/lex"}/inference.sock'
+
+
+class ServedModel(BaseModel):
+    model: str
+    weights_path: str = ''
+    device: str = 'cuda'
+    quantize: bool = False
+    num_threads: int = 0
+    draft_model: str = ''
+    num_draft_tokens: int = 4
+
+
+class ServerSettings(BaseSettings):
+    server_address: str = default_server_address()
+    # The models clients may ask for, by name, e.g. {"mystic": {"model": "gpt2-medium", "weights_path": "m.pt"}}.
+    # Clients never name files themselves: loading weights unpickles them.
+    server_models: Dict[str, ServedModel] = {}
+    server_workers: int = 1  # inference threads per model
+    server_queue_size: int = 64
+    server_max_batch_size: int = 8
+    server_batch_window: float = 0.02
+    server_max_prefix_caches: int = 256
+    server_prefix_cache_ttl: float = 3600
+    server_prefix_cache_memory_mb: float = 1024
+    server_offline: bool = False
+
+
+class InferenceServer:
+    # Owns the models, their batching queues and the lemmatizer for any number of bot processes. Clients ask for a
+    # model by its name in `server_models`, which is loaded the first time it is asked for; requests for the same
+    # model from different bots are batched together.
+
+    def __init__(self, settings: ServerSettings):
+        self.settings = settings
+        self.schedulers = {}  # type: Dict[str, asyncio.Future]
+        self.prefix_caches = ExpiringLruCache(maxsize=settings.server_max_prefix_caches,
+                                              ttl=settings.server_prefix_cache_ttl,
+                                              max_weight=settings.server_prefix_cache_memory_mb * 2 ** 20,
+                                              weigh=lambda x: x.nbytes)
+        self.nlp_executor = InferenceExecutor(1, max_queue_size=settings.server_queue_size, name='nlp')
+        self.num_connections = 0
+        self.num_requests = 0
+
+    async def scheduler(self, request: Dict) -> BatchingScheduler:
+        served = self.settings.server_models.get(request.get('model'))
+        if served is None:
+            raise ValueError(f'Unknown model {request.get("model")!r}')
+        spec = dict(served.dict(),
+                    suppress_token_ids=[int(x) for x in request.get('suppress_token_ids', ())],
+                    stop_token_ids=[int(x) for x in request.get('stop_token_ids', ())])
+        key = json.dumps(spec, sort_keys=True)
+        loading = self.schedulers.get(key)
+        if loading is None:
+            if len(self.schedulers) >= len(self.settings.server_models) * MAX_SCHEDULERS_PER_MODEL:
+                raise ValueError('Too many model variants loaded')
+            loading = self.schedulers[key] = asyncio.ensure_future(self._load(spec))
+        try:
+            return await asyncio.shield(loading)
+        except Exception:
+            if loading.done() and self.schedulers.get(key) is loading:  # a later request tries again
+                del self.schedulers[key]
+            raise
+
+    async def _load(self, spec: Dict) -> BatchingScheduler:
+        executor = InferenceExecutor(self.settings.server_workers, name=f'inference-{len(self.schedulers)}')
+        registry = ModelRegistry.instance()
+        a = time.perf_counter()
+        model = await executor.submit(registry.model,
+                                      spec['model'],
+                                      spec['weights_path'],
+                                      device=spec['device'],
+                                      quantize=spec['quantize'],
+                                      num_threads=spec['num_threads'])
+        print(f'Loaded {spec["model"]} {spec["weights_path"]} on {spec["device"]} in {time.perf_counter() - a:.2f}s')
+        draft_kwargs = {}
+        if spec.get('draft_model'):
+            draft_kwargs = dict(draft_model=await executor.submit(registry.model,
+                                                                  spec['draft_model'],
+                                                                  device=spec['device'],
+                                                                  quantize=spec['quantize'],
+                                                                  num_threads=spec['num_threads']),
+                                num_draft_tokens=spec['num_draft_tokens'])
+        return BatchingScheduler(model,
+                                 executor,
+                                 max_batch_size=self.settings.server_max_batch_size,
+                                 batch_window=self.settings.server_batch_window,
+                                 max_pending=self.settings.server_queue_size,
+                                 suppress_token_ids=tuple(spec['suppress_token_ids']),
+                                 stop_token_ids=tuple(spec['stop_token_ids']),
+                                 **draft_kwargs)
+
+    def prefix_cache(self, key: str):
+        from .sampling import PrefixCache
+        return self.prefix_caches.get_or_create(key, PrefixCache)
+
+    async def generate(self, request: Dict, send):
+        scheduler = await self.scheduler(request)
+        prefix_cache = None
+        if request.get('prefix_cache'):
+            prefix_cache = self.prefix_cache(request['prefix_cache'])
+        on_token = None
+        if request.get('stream'):
+            def on_token(token):
+                send(dict(id=request['id'], token=token))
+        outputs = await scheduler.generate(request['prompt_ids'],
+                                           request['max_length'],
+                                           request['eos_token_id'],
+                                           min_length=request['min_length'],
+                                           num_return_sequences=request['num_return_sequences'],
+                                           prefix_cache=prefix_cache,
+                                           on_token=on_token)
+        if prefix_cache is not None:
+            self.prefix_caches.evict(keep=request['prefix_cache'])  # the prefix cache grew
+        return [[int(x) for x in output] for output in outputs]
+
+    async def lemmatize(self, request: Dict, _):
+        return await self.nlp_executor.submit(msg_utils.lemmatize_batch, request['texts'])
+
+    async def handle(self, request: Dict, send):
+        handler = dict(generate=self.generate, lemmatize=self.lemmatize).get(request.get('op'))
+        try:
+            if handler is None:
+                raise ValueError(f'Unknown op {request.get("op")!r}')
+            result = await handler(request, send)
+        except asyncio.CancelledError:
+            raise
+        except InferenceQueueFullError as e:
+            send(dict(id=request.get('id'), error=str(e), kind='queue_full'))
+        except Exception as e:
+            send(dict(id=request.get('id'), error=repr(e), kind='error'))
+        else:
+            send(dict(id=request.get('id'), result=result))
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = {}  # type: Dict[int, asyncio.Task]
+        self.num_connections += 1
+
+        def send(frame: Dict):
+            if not writer.is_closing():
+                writer.write(encode_frame(frame))
+
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (InferenceServerError, ValueError) as e:  # oversized or malformed; the stream is out of step
+                    send(dict(id=None, error=repr(e), kind='error'))
+                    await writer.drain()
+                    break
+                if request.get('op') == 'cancel':
+                    task = tasks.pop(request.get('id'), None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+                self.num_requests += 1
+                task = asyncio.ensure_future(self.handle(request, send))
+                tasks[request.get('id')] = task
+                task.add_done_callback(lambda _, request_id=request.get('id'): tasks.pop(request_id, None))
+                await writer.drain()
+        finally:
+            self.num_connections -= 1
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def start(self):
+        kind, target = parse_address(self.settings.server_address)
+        if kind == 'unix':
+            os.makedirs(os.path.dirname(target), mode=0o700, exist_ok=True)
+            _remove_stale_socket(target)
+            server = await asyncio.start_unix_server(self.serve_connection, target)
+            os.chmod(target, 0o600)
+            return server
+        return await asyncio.start_server(self.serve_connection, *target)
+
+
+def _remove_stale_socket(path: str):
+    # Only removes a socket left over from a previous run: anything else, or a live server, is an error.
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f'{path} exists and is not a socket')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+    else:
+        raise FileExistsError(f'An inference server is already listening at {path}')
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str,
+                        help='overrides SERVER_ADDRESS, e.g. unix:/run/lex/inference.sock or 127.0.0.1:7878')
+    args = parser.parse_args()
+    settings = ServerSettings()
+    if args.address:
+        settings.server_address = args.address
+    if settings.server_offline:
+        ModelRegistry.instance().local_files_only = True
+        msg_utils.NLP_SETTINGS.nlp_offline = True
+    msg_utils.NLP_SETTINGS.nlp_server = ''  # never lemmatize through ourselves
+    server = InferenceServer(settings)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start())
+    print(f'Serving inference at {settings.server_address}')
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
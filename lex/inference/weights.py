@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from typing import Dict, TYPE_CHECKING
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from torch import nn
+    import torch
+
+
+__all__ = ['write_arrays', 'read_arrays', 'convert_checkpoint', 'mmap_path', 'load_mmap_state_dict', 'skip_init',
+           'load_finetuned']
+
+
+# A header of MAGIC, the JSON index's length and the JSON index itself, then every tensor's raw bytes at an
+# ALIGNMENT-aligned offset. Tensors that shared storage in the checkpoint (GPT-2's tied embeddings) are stored once.
+MAGIC = b'LEXMMAP1'
+ALIGNMENT = 64
+INIT_FNS = ('uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'xavier_uniform_',
+            'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_')
+_INIT_LOCK = threading.Lock()
+
+
+def _pad(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def mmap_path(weights_path: str) -> str:
+    return weights_path if weights_path.endswith('.mmap') else f'{weights_path}.mmap'
+
+
+def write_arrays(arrays: Dict[str, np.ndarray], aliases: Dict[str, str], path: str):
+    index = {}  # type: Dict[str, Dict]
+    offset = 0
+    for name, array in arrays.items():
+        offset += _pad(offset)
+        index[name] = dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset)
+        offset += array.nbytes
+    header = json.dumps(dict(tensors=index, aliases=aliases)).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header)
+    start += _pad(start)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for array, info in zip(arrays.values(), index.values()):
+            f.write(b'\0' * (start + info['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_arrays(path: str) -> Dict[str, np.ndarray]:
+    # Arrays are copy-on-write views of the file: pages are read on first use and shared through the page cache
+    # with every process that maps the same file, until a process writes to them.
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a converted weights file')
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    start = len(MAGIC) + 8 + header_size
+    start += _pad(start)
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    arrays = {}
+    for name, info in header['tensors'].items():
+        dtype = np.dtype(info['dtype'])
+        offset = start + info['offset']
+        nbytes = int(np.prod(info['shape'], dtype=np.int64)) * dtype.itemsize
+        arrays[name] = buffer[offset:offset + nbytes].view(dtype).reshape(info['shape'])
+    for name, target in header['aliases'].items():
+        arrays[name] = arrays[target]
+    return arrays
+
+
+def convert_checkpoint(src: str, dst: str):
+    # One-time conversion of a `torch.save`d state dict; needs the checkpoint in memory once.
+    import torch
+    state_dict = torch.load(src, map_location='cpu')
+    arrays = {}  # type: Dict[str, np.ndarray]
+    aliases = {}  # type: Dict[str, str]
+    stored = {}  # type: Dict[tuple, str]
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tuple(tensor.shape), tuple(tensor.stride()), str(tensor.dtype))
+        if key in stored:
+            aliases[name] = stored[key]
+        else:
+            stored[key] = name
+            arrays[name] = tensor.detach().cpu().numpy()
+    write_arrays(arrays, aliases, dst)
+
+
+def load_mmap_state_dict(path: str) -> Dict[str, 'torch.Tensor']:
+    import torch
+    arrays = read_arrays(path)
+    tensors = {}  # type: Dict[int, torch.Tensor]
+    return {name: tensors.setdefault(id(x), torch.from_numpy(x)) for name, x in arrays.items()}
+
+
+@contextmanager
+def skip_init():
+    # Builds modules without initializing their weights, which are about to be replaced anyway: the parameters stay
+    # untouched torch.empty allocations. Patches torch.nn.init globally, so model construction is serialized.
+    from transformers.modeling_utils import PreTrainedModel
+    import torch
+    with _INIT_LOCK:
+        saved = {name: getattr(torch.nn.init, name) for name in INIT_FNS if hasattr(torch.nn.init, name)}
+        init_weights = PreTrainedModel.init_weights
+        try:
+            for name in saved:
+                setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+            PreTrainedModel.init_weights = lambda self: None
+            yield
+        finally:
+            for name, fn in saved.items():
+                setattr(torch.nn.init, name, fn)
+            PreTrainedModel.init_weights = init_weights
+
+
+def _assign(model: 'nn.Module', state_dict: Dict[str, 'torch.Tensor']):
+    # Like load_state_dict(strict=True) for parameters, but points them at the given tensors instead of copying.
+    # Buffers missing from older checkpoints keep the values the constructor gave them.
+    import torch
+    modules = dict(model.named_modules())
+    params = dict(model.named_parameters())
+    unexpected = []
+    for name, tensor in state_dict.items():
+        module_name, _, attr_name = name.rpartition('.')
+        module = modules.get(module_name)
+        if module is None:
+            unexpected.append(name)
+        elif attr_name in module._parameters:
+            expected = tuple(module._parameters[attr_name].shape)
+            if tuple(tensor.shape) != expected:
+                raise ValueError(f'{name} has shape {tuple(tensor.shape)}, expected {expected}')
+            setattr(module, attr_name, torch.nn.Parameter(tensor, requires_grad=False))
+        elif attr_name in module._buffers:
+            module._buffers[attr_name] = tensor
+        else:
+            unexpected.append(name)
+    missing = [x for x in params if x not in state_dict]
+    if missing or unexpected:
+        raise KeyError(f'Weights do not match the model: missing {missing}, unexpected {unexpected}')
+
+
+def load_finetuned(base_model: str, weights_path: str, local_files_only: bool = False) -> 'nn.Module':
+    # Builds the model straight from the fine-tuned weights, converting them to the mmap format on first use (or
+    # whenever the checkpoint is newer), instead of loading the base weights and then overwriting them.
+    from transformers import GPT2Config, GPT2LMHeadModel
+    import torch
+    path = mmap_path(weights_path)
+    if path != weights_path and os.path.exists(weights_path):
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(weights_path):
+            print(f'Converting {weights_path} to {path}')
+            try:
+                convert_checkpoint(weights_path, path)
+            except OSError as e:
+                print(f'Could not convert {weights_path}, loading it into memory: {e!r}')
+                path = None
+    state_dict = torch.load(weights_path, map_location='cpu') if path is None else load_mmap_state_dict(path)
+    config = GPT2Config.from_pretrained(base_model, local_files_only=local_files_only)
+    with skip_init():
+        model = GPT2LMHeadModel(config)
+    if 'lm_head.weight' not in state_dict and 'transformer.wte.weight' in state_dict:
+        state_dict['lm_head.weight'] = state_dict['transformer.wte.weight']
+    _assign(model, state_dict)
+    model.tie_weights()
+    return model
@@ -1,16 +1,62 @@
+from typing import List, Tuple
+import asyncio
 import enum
 import random
-import time
+import threading
 
 from pydantic import BaseSettings
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import torch
 
-from lex.core import BotModule, Intent, ConstantSelfMentionPredictor, AuthoredMessage
+from lex.core import BotModule, Intent, ConstantSelfMentionPredictor, AuthoredMessage, StreamingReply
+from lex.inference import InferenceExecutor, InferenceQueueFullError, BatchingScheduler, ModelRegistry, InferenceClient,\
+    RemoteScheduler
+from lex.utils import message as msg_utils
+from lex.utils.cache import ExpiringLruCache
 
 
 class DialogueIntentEnum(enum.Enum):
-    DIALOGUE_INTENT = Intent('dialogue')
+    DIALOGUE_INTENT = Intent('dialogue', cost=1)
+
+
+class DialogueThread:
+    # The rolling conversation as (author, text, token ids) entries plus a prefix cache of the model's keys/values.
+    # Entries are encoded once, each with its leading separator, so consecutive contexts share a token prefix and
+    # only new entries run through the model. The window slides in chunks (down to two thirds of its limits) rather
+    # than one entry per turn, since every slide invalidates the cached prefix.
+
+    def __init__(self, tokenizer, join: str, target: str, max_entries: int = 7, max_tokens: int = 64, prefix_cache=None):
+        self.tokenizer = tokenizer
+        self.join = join
+        self.target = target
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.entries = []  # type: List[Tuple[str, str, List[int]]]
+        self.prompt_ids = tokenizer.encode(f'{join}{target} ')
+        if prefix_cache is None:
+            from lex.inference.sampling import PrefixCache
+            prefix_cache = PrefixCache()
+        self.prefix_cache = prefix_cache
+        self.lock = asyncio.Lock()
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(len(x[2]) for x in self.entries) + len(self.prompt_ids)
+
+    def append(self, author: str, text: str):
+        prefix = self.join if self.entries else ''
+        self.entries.append((author, text, msg_utils.encode(self.tokenizer, f'{prefix}{author} {text}')))
+        if len(self.entries) > self.max_entries or self.num_tokens > self.max_tokens:
+            while len(self.entries) > 1 and (len(self.entries) > max(self.max_entries * 2 // 3, 1) or
+                                             self.num_tokens > self.max_tokens * 2 // 3):
+                self.entries.pop(0)
+            author, text, _ = self.entries[0]
+            self.entries[0] = author, text, msg_utils.encode(self.tokenizer, f'{author} {text}')
+
+    def context_ids(self) -> List[int]:
+        ids = [x for entry in self.entries for x in entry[2]] + self.prompt_ids
+        return ids[-self.max_tokens:]
+
+    def context_text(self) -> str:
+        return self.tokenizer.decode(self.context_ids())
 
 
 class DialogueSettings(BaseSettings):
@@ -23,6 +69,27 @@ class DialogueSettings(BaseSettings):
     dialogue_model: str = 'gpt2-medium'
     dialogue_min_length: int = 10
     dialogue_model_path: str = 'gpt2-medium-mm.pt'
+    dialogue_workers: int = 1
+    dialogue_queue_size: int = 32
+    dialogue_max_batch_size: int = 8
+    dialogue_batch_window: float = 0.02
+    dialogue_num_candidates: int = 4
+    dialogue_device: str = 'cuda'
+    dialogue_quantize: bool = True
+    dialogue_num_threads: int = 0
+    dialogue_draft_model: str = ''  # e.g. distilgpt2, to decode speculatively with it; a directory loads local files
+    dialogue_draft_tokens: int = 4
+    dialogue_server: str = ''  # address of an inference server that holds the model, instead of loading it here
+    dialogue_server_model: str = 'dialogue'  # the server's name for the model, one of its SERVER_MODELS
+    dialogue_history_size: int = 7
+    dialogue_context_tokens: int = 64
+    dialogue_per_author: bool = False
+    dialogue_max_conversations: int = 64
+    dialogue_conversation_ttl: float = 3600
+    dialogue_cache_memory_mb: float = 512
+    dialogue_reply_delay: float = 1
+    dialogue_stream: bool = True
+    dialogue_stream_interval: float = 1
 
 
 class DialogueModule(BotModule):
@@ -33,76 +100,167 @@ class DialogueModule(BotModule):
         self.register_intent(DialogueIntentEnum.DIALOGUE_INTENT.value)
         self.register_predictor(ConstantSelfMentionPredictor(DialogueIntentEnum.DIALOGUE_INTENT.value, 0.5))
         DialogueIntentEnum.DIALOGUE_INTENT.value.register_handler(self.handle_dialogue)
-        self.tokenizer = GPT2Tokenizer.from_pretrained(settings.dialogue_model)
-        self.model = GPT2LMHeadModel.from_pretrained(settings.dialogue_model)
-        self.model.load_state_dict(torch.load(settings.dialogue_model_path))
-        self.model = self.model.cuda()
-        self.model.eval()
         self.settings = settings
-        self.thread = []
-        self.eos_id = self.tokenizer.encode(' |')[0]
+        self.executor = InferenceExecutor(settings.dialogue_workers, name='dialogue')
+        self.tokenizer = None
+        self.model = None
+        self.scheduler = None  # type: BatchingScheduler
+        self.load_lock = threading.Lock()
+        self.threads = ExpiringLruCache(maxsize=settings.dialogue_max_conversations,
+                                        ttl=settings.dialogue_conversation_ttl,
+                                        max_weight=settings.dialogue_cache_memory_mb * 2 ** 20,
+                                        weigh=lambda x: x.prefix_cache.nbytes)
+        self.eos_id = None
+
+    def load_model(self):
+        with self.load_lock:
+            if self.scheduler is not None:
+                return
+            registry = ModelRegistry.instance()
+            self.tokenizer = registry.tokenizer(self.settings.dialogue_model)
+            self.eos_id = self.tokenizer.encode(' |')[0]
+            if self.settings.dialogue_server:
+                self.scheduler = RemoteScheduler(InferenceClient.shared(self.settings.dialogue_server),
+                                                 self.settings.dialogue_server_model,
+                                                 max_batch_size=self.settings.dialogue_max_batch_size,
+                                                 suppress_token_ids=(self.tokenizer.eos_token_id,),
+                                                 stop_token_ids=(self.tokenizer.eos_token_id,))
+                return
+            self.model = registry.model(self.settings.dialogue_model,
+                                        self.settings.dialogue_model_path,
+                                        device=self.settings.dialogue_device,
+                                        quantize=self.settings.dialogue_quantize,
+                                        num_threads=self.settings.dialogue_num_threads)
+            draft_kwargs = {}
+            if self.settings.dialogue_draft_model:
+                draft_kwargs = dict(draft_model=registry.model(self.settings.dialogue_draft_model,
+                                                               device=self.settings.dialogue_device,
+                                                               quantize=self.settings.dialogue_quantize,
+                                                               num_threads=self.settings.dialogue_num_threads),
+                                    num_draft_tokens=self.settings.dialogue_draft_tokens)
+            self.scheduler = BatchingScheduler(self.model,
+                                               self.executor,
+                                               max_batch_size=self.settings.dialogue_max_batch_size,
+                                               batch_window=self.settings.dialogue_batch_window,
+                                               max_pending=self.settings.dialogue_queue_size,
+                                               suppress_token_ids=(self.tokenizer.eos_token_id,),
+                                               stop_token_ids=(self.tokenizer.eos_token_id,),
+                                               **draft_kwargs)
+
+    def make_thread(self) -> DialogueThread:
+        return DialogueThread(self.tokenizer,
+                              ' | ' if self.settings.dialogue_target_space else ' |',
+                              self.settings.dialogue_target,
+                              max_entries=self.settings.dialogue_history_size,
+                              max_tokens=self.settings.dialogue_context_tokens,
+                              prefix_cache=self.scheduler.new_prefix_cache())
+
+    async def ensure_model(self):
+        if self.scheduler is None:
+            await self.executor.submit(self.load_model)
+
+    def on_warmup(self):
+        self.load_model()
 
-    def make_dialogue(self, text, author=None):
+    def thread_key(self, message: AuthoredMessage):
+        if self.settings.dialogue_per_author:
+            return message.disc_message.channel.id, message.author_name
+        return message.disc_message.channel.id
+
+    def make_dialogue(self, thread: DialogueThread, text, author=None):
         if self.settings.dialogue_capitalize:
             text = text.capitalize().strip()
-        if self.settings.dialogue_punctuate:
+        if self.settings.dialogue_punctuate and text.strip():
             if text.strip()[-1] not in ('?', '!', '.'):
                 text = f'{text.strip()}.'
         if author is None:
             author = self.settings.dialogue_selfname
-        self.thread.append((author, text))
-        self.thread = self.thread[-7:]
-        target = self.settings.dialogue_target
-        join = ' | ' if self.settings.dialogue_target_space else ' |'
-        thread_messages = [' '.join(x) for x in self.thread]
-        cond_text = f'{join.join(thread_messages)}{join}{target} '
-        return cond_text
+        thread.append(author, text)
+
+    async def generate_reply(self, thread: DialogueThread, min_length):
+        cond_ids = thread.context_ids()
+        min_total_length = min(len(cond_ids) + max(min_length // 4, 1), 128)
+        texts = []
+        for _ in range(2):
+            candidates = await self.scheduler.generate(cond_ids, 128, self.eos_id, min_length=min_total_length,
+                                                       num_return_sequences=self.settings.dialogue_num_candidates,
+                                                       prefix_cache=thread.prefix_cache)
+            texts = [self.decode_reply(x) for x in candidates]
+            text = msg_utils.pick_candidate(texts, max(min_length, 1))
+            if text is not None:
+                return text
+        return max(texts, key=len)
+
+    async def stream_reply(self, thread: DialogueThread, channel, author_name, min_length):
+        # Streams a single candidate into the channel while it is generated, instead of picking among several.
+        cond_ids = thread.context_ids()
+        reply = StreamingReply(channel,
+                               transform=lambda x: x.replace('{0}', author_name),
+                               min_interval=self.settings.dialogue_stream_interval)
+        text = ''
+        async for text in msg_utils.stream_sample(self.scheduler,
+                                                  self.tokenizer,
+                                                  cond_ids,
+                                                  max_length=128,
+                                                  min_length=min(len(cond_ids) + max(min_length // 4, 1), 128),
+                                                  prefix_cache=thread.prefix_cache):
+            await reply.update(text)
+        text = text.strip()
+        await reply.finish(text)
+        return text
+
+    def decode_reply(self, token_ids):
+        text = self.tokenizer.decode(token_ids)
+        text = text.replace(' |', '').strip()
+        if '<|endoftext|>' in text:
+            idx = text.find('<|endoftext|>')
+            text = text[:idx]
+        return text
 
     async def handle_dialogue(self, message: AuthoredMessage, _):
         async def step():
             await message.disc_message.channel.trigger_typing()
-            cond_ids = self.tokenizer.encode(cond_text)
-            cond_ids = cond_ids[-64:]
-            try:
-                cond_ids = cond_ids[cond_ids.find(self.eos_id) + 1:]
-                print('truncated')
-            except:
-                pass
-            cond_ids = torch.tensor([cond_ids]).cuda()
-            length = -1
-            attempts = 0
             min_length = self.settings.dialogue_min_length
             if random.random() < 0.2:
                 min_length = 20
-            while length < min_length or length == 0:
-                token_ids = self.model.generate(cond_ids, do_sample=True, max_length=128, eos_token_id=self.eos_id).tolist()
-                token_ids = token_ids[0]
-                token_ids = token_ids[cond_ids.size(1):]
-                text = self.tokenizer.decode(token_ids)
-                text = text.replace(' |', '').strip()
-                if '<|endoftext|>' in text:
-                    idx = text.find('<|endoftext|>')
-                    text = text[:idx]
-                length = len(text)
-                attempts += 1
-                if attempts >= 20 and length != 0:
-                    break
-            await message.disc_message.channel.send(text.replace('{0}', message.author_name))
+            if self.settings.dialogue_stream:
+                text = await self.stream_reply(thread, message.disc_message.channel, message.author_name, min_length)
+                self.threads.evict(keep=thread_key)  # the prefix cache grew
+                return text
+            text = await self.generate_reply(thread, min_length)
+            self.threads.evict(keep=thread_key)  # the prefix cache grew
+            if text.strip():  # every candidate can come back empty
+                await message.disc_message.channel.send(text.replace('{0}', message.author_name))
             return text
         orig_author = message.author_name
-        cond_text = self.make_dialogue(message.message_content, author=self.settings.dialogue_selfname)
-        text = await step()
-        counter = 0
-
-        while random.random() < 0.6:
-            message.author_name = self.settings.dialogue_target
-            message.message_content = text.replace('{0}', message.author_name)
-            cond_text = self.make_dialogue(message.message_content.replace(orig_author, '{0}'),
-                                           message.author_name)
-            text = await step()
-            time.sleep(1)
-            counter += 1
-            if counter > 5:
-                break
-        print(cond_text)
-        self.thread.append((self.settings.dialogue_target, text))
+        try:
+            await self.ensure_model()
+        except InferenceQueueFullError:
+            await message.disc_message.channel.send(f'I\'m busy right now, {message.author_name}. Try again in a bit.')
+            return
+        thread_key = self.thread_key(message)
+        thread = self.threads.get_or_create(thread_key, self.make_thread)
+        async with thread.lock:
+            try:
+                self.make_dialogue(thread, message.message_content, author=self.settings.dialogue_selfname)
+                text = await step()
+            except InferenceQueueFullError:
+                await message.disc_message.channel.send(f'I\'m busy right now, {message.author_name}. Try again in a bit.')
+                return
+            counter = 0
+
+            while text.strip() and random.random() < 0.6:
+                message.author_name = self.settings.dialogue_target
+                message.message_content = text.replace('{0}', message.author_name)
+                self.make_dialogue(thread, message.message_content.replace(orig_author, '{0}'), message.author_name)
+                try:
+                    text = await step()
+                except InferenceQueueFullError:
+                    break
+                await asyncio.sleep(self.settings.dialogue_reply_delay)
+                counter += 1
+                if counter > 5:
+                    break
+            print(thread.context_text())
+            if text.strip():
+                thread.append(self.settings.dialogue_target, text)
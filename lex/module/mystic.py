@@ -1,18 +1,20 @@
 from collections import deque, defaultdict
 from hashlib import md5
-from typing import List, Dict
+from typing import List
 import enum
 import re
+import threading
 import time
 
-from discord import TextChannel
 from pydantic import BaseSettings
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import torch
 
 from lex.core import BotModule, IntentPredictor, Intent, AuthoredMessage, IntentSelfMentionFilterMixin, IntentPrediction,\
-    RegexIntentPredictor, LemmaRegexIntentPredictor, MentionedRegexIntentPredictor
+    RegexIntentPredictor, LemmaRegexIntentPredictor, MentionedRegexIntentPredictor, StreamingReply
+from lex.inference import InferenceExecutor, InferenceQueueFullError, BatchingScheduler, ModelRegistry, SamplePool,\
+    InferenceClient, RemoteScheduler
 from lex.utils import message as msg_utils
+from lex.utils.arith import MathEvaluator, MathError
+from lex.utils.metrics import METRICS
 
 
 __all__ = ['MysticBotModule']
@@ -22,11 +24,13 @@ class MysticIntentEnum(enum.Enum):
     UNKNOWN = Intent('unknown')
     MATH = Intent('math')
     WHOS_BEST = Intent('whosbest')
-    SAMPLE = Intent('sample')
-    REPLY = Intent('reply')
+    SAMPLE = Intent('sample', cost=1)
+    REPLY = Intent('reply', cost=1)
 
 
 class UnknownIntentPredictor(IntentSelfMentionFilterMixin, IntentPredictor):
+    max_rel = 0.1
+
     def on_predict(self, message: AuthoredMessage) -> List[IntentPrediction]:
         return [IntentPrediction(0.1, MysticIntentEnum.UNKNOWN.value)]
 
@@ -41,9 +45,14 @@ class WhosBestIntentPredictor(LemmaRegexIntentPredictor):
         super().__init__({re.compile(r'^(who be best|whos best|who be the best|whos the best).*$'): MysticIntentEnum.WHOS_BEST.value})
         self.last_authors = deque()
 
-    def on_predict(self, message: AuthoredMessage) -> List[IntentPrediction]:
+    def observe(self, message: AuthoredMessage):
         self.last_authors.append((int(md5(f'{time.time()}{message.author_name}'.encode()).hexdigest(), 16), message.author_name))
         if len(self.last_authors) > 50: self.last_authors.popleft()
+
+    def upper_bound(self, message: AuthoredMessage) -> float:
+        return self.max_rel if message.attributes['self-mention'] else 0
+
+    def on_predict(self, message: AuthoredMessage) -> List[IntentPrediction]:
         if not message.attributes['self-mention']:
             return [IntentPrediction(0, MysticIntentEnum.WHOS_BEST.value)]
 
@@ -54,11 +63,6 @@ class WhosBestIntentPredictor(LemmaRegexIntentPredictor):
         await message.disc_message.channel.send(f'{best_name} is the best.')
 
 
-async def execute_math_message(message: AuthoredMessage, data):
-    answer = float(msg_utils.eval_expr(message.message_content.replace('^', '**')))
-    await message.disc_message.channel.send(f'Answer: {answer:.5}')
-
-
 async def execute_unknown_message(message: AuthoredMessage, data):
     await message.disc_message.channel.send(f'I don\'t know how to answer that, {message.author_name}.')
 
@@ -71,8 +75,30 @@ class MysticSettings(BaseSettings):
     sample_format: str = '{target} '
     sample_model: str = 'gpt2-medium'
     sample_model_path: str = 'gpt2-medium.pt'
-    sample_cooldown: int = 5
-    cooldowns: Dict[str, int] = ''
+    sample_workers: int = 1
+    sample_queue_size: int = 32
+    sample_max_batch_size: int = 8
+    sample_batch_window: float = 0.02
+    sample_num_candidates: int = 4
+    sample_device: str = 'cuda'
+    sample_quantize: bool = True
+    sample_num_threads: int = 0
+    sample_draft_model: str = ''  # e.g. distilgpt2, to decode speculatively with it; a directory loads local files
+    sample_draft_tokens: int = 4
+    sample_server: str = ''  # address of an inference server that holds the model, instead of loading it here
+    sample_server_model: str = 'mystic'  # the server's name for the model, one of its SERVER_MODELS
+    sample_stream: bool = True
+    sample_stream_interval: float = 1
+    sample_pool_size: int = 2  # samples kept ready per frequently sampled target; zero to disable
+    sample_pool_targets: int = 12
+    sample_pool_min_requests: float = 2  # decayed request count that makes a target frequent
+    sample_pool_half_life: int = 200  # requests after which a request counts half
+    sample_pool_max_bytes: int = 65536
+    sample_pool_priority: str = 'idle'  # or 'spare', to also refill in the spare rows of busy batches
+    math_workers: int = 1
+    math_timeout: float = 1
+    math_memory_mb: float = 256
+    math_cache_size: int = 1024
 
 
 class MysticBotModule(BotModule):
@@ -91,50 +117,148 @@ class MysticBotModule(BotModule):
                                                                re.compile(r'^(reply|respond)\s+(.+?)\s+(.+?)$', re.IGNORECASE): MysticIntentEnum.REPLY.value}))
 
         MysticIntentEnum.UNKNOWN.value.register_handler(execute_unknown_message)
-        MysticIntentEnum.MATH.value.register_handler(execute_math_message)
+        MysticIntentEnum.MATH.value.register_handler(self.execute_math_message)
         MysticIntentEnum.WHOS_BEST.value.register_handler(wb_predictor)
         MysticIntentEnum.SAMPLE.value.register_handler(self.sample_message)
         MysticIntentEnum.REPLY.value.register_handler(self.sample_reply)
         self.settings = settings
-        self.tokenizer = GPT2Tokenizer.from_pretrained(settings.sample_model)
-        self.model = GPT2LMHeadModel.from_pretrained(settings.sample_model)
-        self.model.load_state_dict(torch.load(settings.sample_model_path))
-        self.model = self.model.cuda()
-        self.model.eval()
-        self.last_send_map = dict()
-        self.last_notif_map = dict()
-
-    async def check_delay(self, author_name: str, disc_channel: TextChannel):
-        cooldown = self.settings.cooldowns.get(disc_channel.name, self.settings.sample_cooldown)
-        if time.time() - self.last_send_map.get(author_name, 0) < cooldown:
-            if time.time() - self.last_notif_map.get(author_name, 0) > cooldown:
-                self.last_notif_map[author_name] = time.time()
-                await disc_channel.send(f'Please wait {cooldown} seconds between sample requests.')
+        self.executor = InferenceExecutor(settings.sample_workers, name='mystic-sample')
+        self.tokenizer = None
+        self.model = None
+        self.scheduler = None  # type: BatchingScheduler
+        self.load_lock = threading.Lock()
+        self.math = MathEvaluator(settings.math_workers,
+                                  timeout=settings.math_timeout,
+                                  max_memory_mb=settings.math_memory_mb,
+                                  cache_size=settings.math_cache_size)
+        self.pool = None  # type: SamplePool
+        if settings.sample_pool_size > 0:
+            self.pool = SamplePool(self.generate_sample,
+                                   self.can_pregenerate,
+                                   pool_size=settings.sample_pool_size,
+                                   max_prompts=settings.sample_pool_targets,
+                                   min_requests=settings.sample_pool_min_requests,
+                                   max_bytes=settings.sample_pool_max_bytes,
+                                   half_life=settings.sample_pool_half_life)
+            METRICS.gauge('lex_sample_pool_hit_ratio', lambda: self.pool.hit_rate, 'Samples answered from the pool')
+            METRICS.gauge('lex_sample_pool_bytes', lambda: self.pool.num_bytes, 'Size of the pooled samples')
+
+    def load_model(self):
+        with self.load_lock:
+            if self.scheduler is not None:
+                return
+            registry = ModelRegistry.instance()
+            self.tokenizer = registry.tokenizer(self.settings.sample_model)
+            if self.settings.sample_server:
+                self.scheduler = RemoteScheduler(InferenceClient.shared(self.settings.sample_server),
+                                                 self.settings.sample_server_model,
+                                                 max_batch_size=self.settings.sample_max_batch_size,
+                                                 suppress_token_ids=(self.tokenizer.eos_token_id,),
+                                                 stop_token_ids=(self.tokenizer.eos_token_id,))
+                return
+            self.model = registry.model(self.settings.sample_model,
+                                        self.settings.sample_model_path,
+                                        device=self.settings.sample_device,
+                                        quantize=self.settings.sample_quantize,
+                                        num_threads=self.settings.sample_num_threads)
+            draft_kwargs = {}
+            if self.settings.sample_draft_model:
+                draft_kwargs = dict(draft_model=registry.model(self.settings.sample_draft_model,
+                                                               device=self.settings.sample_device,
+                                                               quantize=self.settings.sample_quantize,
+                                                               num_threads=self.settings.sample_num_threads),
+                                    num_draft_tokens=self.settings.sample_draft_tokens)
+            self.scheduler = BatchingScheduler(self.model,
+                                               self.executor,
+                                               max_batch_size=self.settings.sample_max_batch_size,
+                                               batch_window=self.settings.sample_batch_window,
+                                               max_pending=self.settings.sample_queue_size,
+                                               suppress_token_ids=(self.tokenizer.eos_token_id,),
+                                               stop_token_ids=(self.tokenizer.eos_token_id,),
+                                               **draft_kwargs)
+
+    async def ensure_model(self):
+        if self.scheduler is None:
+            await self.executor.submit(self.load_model)
+
+    def on_warmup(self):
+        self.math.start()
+        self.load_model()
+
+    def can_pregenerate(self) -> bool:
+        if self.scheduler is None:
             return False
-        self.last_send_map[author_name] = time.time()
-        return True
+        if self.settings.sample_pool_priority == 'spare':
+            return self.scheduler.num_pending_rows + self.settings.sample_num_candidates <= self.scheduler.max_batch_size
+        return self.scheduler.is_idle and self.executor.is_idle
 
-    async def sample_reply(self, message: AuthoredMessage, data):
-        if not await self.check_delay(message.author_name, message.disc_message.channel):
+    async def generate_sample(self, format_text: str) -> str:
+        return await msg_utils.sample_gpt2(self.scheduler,
+                                           self.tokenizer,
+                                           format_text,
+                                           num_candidates=self.settings.sample_num_candidates)
+
+    async def execute_math_message(self, message: AuthoredMessage, data):
+        try:
+            answer = await self.math.evaluate(message.message_content.replace('^', '**'))
+        except MathError as e:
+            await message.disc_message.channel.send(f'I can\'t answer that, {message.author_name}: {e}.')
             return
+        await message.disc_message.channel.send(f'Answer: {answer:.5}')
+
+    async def sample_reply(self, message: AuthoredMessage, data):
         target_username = data['groups'][1]
         source_text = data['groups'][2]
-        await message.disc_message.channel.send(msg_utils.sample_gpt2_mc_dialogue(self.model,
-                                                                                  self.tokenizer,
-                                                                                  target_username,
-                                                                                  message.author_name,
-                                                                                  source_text))
+        try:
+            await self.ensure_model()
+            text = await msg_utils.sample_gpt2_mc_dialogue(self.scheduler,
+                                                           self.tokenizer,
+                                                           target_username,
+                                                           message.author_name,
+                                                           source_text,
+                                                           num_candidates=self.settings.sample_num_candidates)
+        except InferenceQueueFullError:
+            await message.disc_message.channel.send(f'I\'m busy right now, {message.author_name}. Try again in a bit.')
+            return
+        await message.disc_message.channel.send(text)
 
     async def sample_message(self, message: AuthoredMessage, data):
-        if not await self.check_delay(message.author_name, message.disc_message.channel):
-            return
         username = data['groups'][1]
         format_text = self.settings.sample_format.format(target=username)
         if ' ' in username:  # contains conditional text
             format_text = format_text.rstrip()
         splits = format_text.split(' ', 1)
-        text = msg_utils.sample_gpt2(self.model, self.tokenizer, format_text)
+        text = None
+        if self.pool is not None and ' ' not in username:
+            self.pool.start()
+            text = self.pool.pop(format_text)
+        if text is None and self.settings.sample_stream:
+            return await self.stream_message(message, format_text, splits)
+        if text is None:
+            try:
+                await self.ensure_model()
+                text = await self.generate_sample(format_text)
+            except InferenceQueueFullError:
+                await message.disc_message.channel.send(f'I\'m busy right now, {message.author_name}. Try again in a bit.')
+                return
         if len(splits) > 1:
             text = f' {splits[1]}{text}'
         username = splits[0]
         await message.disc_message.channel.send(f'<{username}>{text}')
+
+    async def stream_message(self, message: AuthoredMessage, format_text: str, splits: List[str]):
+        prefix = f'<{splits[0]}>'
+        if len(splits) > 1:
+            prefix = f'{prefix} {splits[1]}'
+        reply = StreamingReply(message.disc_message.channel,
+                               prefix=prefix,
+                               min_interval=self.settings.sample_stream_interval)
+        try:
+            await self.ensure_model()
+            await message.disc_message.channel.trigger_typing()
+            async for text in msg_utils.stream_gpt2(self.scheduler, self.tokenizer, format_text):
+                await reply.update(text)
+        except InferenceQueueFullError:
+            await message.disc_message.channel.send(f'I\'m busy right now, {message.author_name}. Try again in a bit.')
+            return
+        await reply.finish()
@@ -1,19 +1,37 @@
 from collections import defaultdict
-from typing import List
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+import csv
+import os
+import pickle
 import re
+import string
+import threading
+import time
 
 from pydantic import BaseSettings
-import pandas as pd
 
 from lex.core import BotModule, IntentPredictor, Intent, AuthoredMessage, IntentSelfMentionFilterMixin, IntentPrediction,\
-    RegexIntentPredictor, LemmaRegexIntentPredictor, MentionedRegexIntentPredictor
+    RegexIntentPredictor, LemmaRegexIntentPredictor, MentionedRegexIntentPredictor, IntentRegistry,\
+    MentionedEmbeddingIntentPredictor
 from lex.utils import message as msg_utils
+from lex.utils.embedding import EmbeddingIndex, HashedNgramEmbedder
+from lex.utils.regex import RegexIndex
+
+
+INDEX_VERSION = 3
 
 
 class QaSettings(BaseSettings):
     entities_path = 'data/entities.tsv'
     responses_path = 'data/responses.tsv'
     rules_path = 'data/simple-qa-rules.tsv'
+    qa_index_path = 'data/.qa-index.pickle'  # compiled rules, rebuilt whenever a TSV changes; empty to disable
+    qa_watch_interval: float = 5  # seconds between checks of the TSVs for edits; zero to disable
+    qa_examples_path = 'data/qa-examples.tsv'  # example questions per response, matched fuzzily
+    qa_fuzzy_threshold: float = 0.4
+    qa_fuzzy_max_rel: float = 0.9
+    qa_fuzzy_dim: int = 2048  # the example matrix takes 4 * dim bytes per example
 
 
 class Answerer:
@@ -24,25 +42,140 @@ class Answerer:
         await message.disc_message.channel.send(self.response.format(author=message.author_name, **data.get('groupdict', {})))
 
 
+@dataclass
+class QaIndex:
+    signature: Tuple
+    responses: Dict[str, str]  # response name to response
+    rule_responses: List[str]  # response name of each of the matcher's patterns
+    matcher: RegexIndex
+    example_responses: List[str]  # response name of each of the embedded examples
+    embeddings: Optional[EmbeddingIndex]
+
+
+def read_tsv(path: str) -> List[Dict[str, str]]:
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE))
+
+
+def _file_signature(path: str) -> Tuple:
+    if not os.path.exists(path):
+        return path, None, None
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _format_fields(text: str) -> set:
+    return {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+
+
+def qa_signature(settings: QaSettings) -> Tuple:
+    paths = (settings.entities_path, settings.rules_path, settings.responses_path, settings.qa_examples_path)
+    return (INDEX_VERSION, settings.qa_fuzzy_dim) + tuple(_file_signature(path) for path in paths if path)
+
+
+def compile_qa_index(settings: QaSettings, signature: Tuple) -> QaIndex:
+    entity_map = {x['name']: x['entity'] for x in read_tsv(settings.entities_path)}
+    rules_map = defaultdict(list)
+    for x in read_tsv(settings.rules_path):
+        rules_map[x['response']].append(x['rule'].format(**entity_map))
+    responses = {x['name']: x['response'] for x in read_tsv(settings.responses_path)}
+    rule_map = {}  # type: Dict[str, str]  # a rule listed for several responses answers with the last
+    for name in responses:
+        rule_map.update({rule: name for rule in rules_map[name]})
+    matcher = RegexIndex([re.compile(rule, re.IGNORECASE) for rule in rule_map])
+    examples = []
+    if settings.qa_examples_path and os.path.exists(settings.qa_examples_path):
+        # Fuzzy matches have no regex groups, so only responses that need nothing but the author can answer them.
+        fuzzy = {name for name, response in responses.items() if _format_fields(response) <= {'author'}}
+        examples = [x for x in read_tsv(settings.qa_examples_path) if x['response'] in fuzzy]
+    embeddings = None
+    if examples:
+        embeddings = EmbeddingIndex([x['example'] for x in examples], HashedNgramEmbedder(settings.qa_fuzzy_dim))
+    return QaIndex(signature, responses, list(rule_map.values()), matcher, [x['response'] for x in examples], embeddings)
+
+
+def load_qa_index(settings: QaSettings) -> QaIndex:
+    # Unpickles the cached index if it was built from the current TSVs, or else compiles and caches a new one.
+    signature = qa_signature(settings)
+    path = settings.qa_index_path
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                index = pickle.load(f)
+            if isinstance(index, QaIndex) and index.signature == signature:
+                return index
+        except Exception as e:
+            print(f'Ignoring QA index {path}: {e!r}')
+    index = compile_qa_index(settings, signature)
+    if path:
+        try:
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Could not cache QA index at {path}: {e!r}')
+    return index
+
+
+class QaRuleWatcher(threading.Thread):
+    # Polls the TSVs and hands a freshly compiled index to `on_change` after every edit. A broken edit keeps the
+    # previous rules in place until the files are fixed.
+
+    def __init__(self, settings: QaSettings, signature: Tuple, on_change: Callable[[QaIndex], None]):
+        super().__init__(name='qa-watcher', daemon=True)
+        self.settings = settings
+        self.signature = signature
+        self.on_change = on_change
+
+    def run(self):
+        while True:
+            time.sleep(self.settings.qa_watch_interval)
+            try:
+                signature = qa_signature(self.settings)
+                if signature == self.signature:
+                    continue
+                self.signature = signature
+                a = time.perf_counter()
+                self.on_change(load_qa_index(self.settings))
+                print(f'Reloaded QA rules in {time.perf_counter() - a:.2f}s')
+            except Exception as e:
+                print(f'Could not reload QA rules: {e!r}')
+
+
 class MysticQaBotModule(BotModule):
     name = 'mystic-qa'
 
     def __init__(self, settings: QaSettings):
         super().__init__()
         self.settings = settings
-        entities_df = pd.read_csv(settings.entities_path, sep='\t', quoting=3)
-        rules_df = pd.read_csv(settings.rules_path, sep='\t', quoting=3)
-        responses_df = pd.read_csv(settings.responses_path, sep='\t', quoting=3)
-
-        entity_map = {x.name: x.entity for x in entities_df.itertuples()}
-        rules_map = defaultdict(list)
-        for x in rules_df.itertuples():
-            rules_map[x.response].append(re.compile(x.rule.format(**entity_map), re.IGNORECASE))
-
-        match_map = {}
-        for x in responses_df.itertuples():
-            intent = Intent(x.name)
-            intent.register_handler(Answerer(x.response))
-            self.register_intent(intent)
-            match_map.update({k: intent for k in rules_map[x.name]})
-        self.register_predictor(LemmaRegexIntentPredictor(match_map))
+        self.intents = []  # type: List[Intent]
+        self.qa_predictors = []  # type: List[IntentPredictor]
+        index = load_qa_index(settings)
+        self.install(index)
+        if settings.qa_watch_interval > 0:
+            QaRuleWatcher(settings, index.signature, self.install).start()
+
+    def install(self, index: QaIndex):
+        # Swaps in the intents and predictors of a new index. The predictor list is replaced with one assignment, so
+        # a message is routed entirely by either the old rules or the new ones.
+        intents = {}  # type: Dict[str, Intent]
+        for name, response in index.responses.items():
+            intents[name] = Intent(name)
+            intents[name].namespace = self.name
+            intents[name].register_handler(Answerer(response))
+        predictors = [LemmaRegexIntentPredictor.from_index(index.matcher, [intents[x] for x in index.rule_responses])]
+        if index.embeddings is not None:
+            predictors.append(MentionedEmbeddingIntentPredictor(index.embeddings,
+                                                                [intents[x] for x in index.example_responses],
+                                                                threshold=self.settings.qa_fuzzy_threshold,
+                                                                max_rel=self.settings.qa_fuzzy_max_rel))
+        registry = IntentRegistry.instance()
+        with registry.lock:
+            for intent in self.intents:
+                registry.unregister(intent)
+            for intent in intents.values():
+                registry.register(intent)
+        self.predictors = [x for x in self.predictors if x not in self.qa_predictors] + predictors
+        self.intents = list(intents.values())
+        self.qa_predictors = predictors
@@ -1,14 +1,29 @@
+import time
+START_TIME = time.perf_counter()
+
 from lex.core import MinecraftDiscordCore, BotSettings
+from lex.inference import ModelRegistry
 from lex.module import mystic, dialogue, mystic_qa
+import lex.utils.message as msg_utils
 
 
 def main():
+    phases = [('imports', time.perf_counter() - START_TIME)]
+    a = time.perf_counter()
     settings = BotSettings()
+    if settings.offline:
+        ModelRegistry.instance().local_files_only = True
+        msg_utils.NLP_SETTINGS.nlp_offline = True
     if settings.preset_name == 'mysticmessenger':
-        core = MinecraftDiscordCore(settings, [dialogue.DialogueModule(dialogue.DialogueSettings())])
+        modules = [dialogue.DialogueModule(dialogue.DialogueSettings())]
     else:
-        core = MinecraftDiscordCore(settings, [mystic.MysticBotModule(mystic.MysticSettings()),
-                                               mystic_qa.MysticQaBotModule(mystic_qa.QaSettings())])
+        modules = [mystic.MysticBotModule(mystic.MysticSettings()),
+                   mystic_qa.MysticQaBotModule(mystic_qa.QaSettings())]
+    phases.append(('modules', time.perf_counter() - a))
+    a = time.perf_counter()
+    core = MinecraftDiscordCore(settings, modules)
+    phases.append(('core', time.perf_counter() - a))
+    print('Startup: ' + ', '.join(f'{name} {secs:.2f}s' for name, secs in phases))
     core.run(settings.api_token)
 
 
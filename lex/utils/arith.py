@@ -0,0 +1,170 @@
+from typing import Optional, Set
+import ast
+import asyncio
+import math
+import multiprocessing
+import operator as op
+import os
+import threading
+
+from .cache import ExpiringLruCache
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+__all__ = ['MathError', 'eval_expr', 'MathEvaluator']
+
+
+MATH_OPS = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul, ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor, ast.USub: op.neg}
+MAX_EXPR_LENGTH = 256
+MAX_DIGITS = 400  # answers are floats, which top out around 1e308
+
+
+class MathError(Exception):
+    pass
+
+
+def _digits(x) -> float:
+    return math.log10(abs(x)) if x else -math.inf
+
+
+def _check_digits(digits: float):
+    if digits > MAX_DIGITS:
+        raise MathError('the result is too large')
+
+
+def eval_expr(expr: str):
+    # Evaluates an arithmetic expression. The magnitude of every product and power is estimated from its operands
+    # before computing it, so no expression can build a huge integer.
+    if len(expr) > MAX_EXPR_LENGTH:
+        raise MathError('the expression is too long')
+    try:
+        value = eval_(ast.parse(expr, mode='eval').body)
+    except (SyntaxError, TypeError, KeyError, ValueError):
+        raise MathError('that isn\'t arithmetic')
+    except ZeroDivisionError:
+        raise MathError('division by zero')
+    except OverflowError:
+        raise MathError('the result is too large')
+    if isinstance(value, complex):
+        raise MathError('the result is complex')
+    return value
+
+
+def eval_(node):
+    if isinstance(node, ast.Num): # <number>
+        return node.n
+    elif isinstance(node, ast.BinOp): # <left> <operator> <right>
+        left, right = eval_(node.left), eval_(node.right)
+        if isinstance(node.op, ast.Mult):
+            _check_digits(_digits(left) + _digits(right))
+        elif isinstance(node.op, ast.Pow) and abs(left) > 1:
+            _check_digits(right * _digits(left))
+        return MATH_OPS[type(node.op)](left, right)
+    elif isinstance(node, ast.UnaryOp): # <operator> <operand> e.g., -1
+        return MATH_OPS[type(node.op)](eval_(node.operand))
+    else:
+        raise TypeError(node)
+
+
+def _limit_memory(max_bytes: int):
+    # The budget comes on top of what the worker already maps, since spawned workers import the main module first
+    if resource is None or max_bytes <= 0:
+        return
+    try:
+        with open('/proc/self/statm') as f:
+            max_bytes += int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def _evaluate(expr: str):
+    try:
+        return float(eval_expr(expr))
+    except MathError as e:
+        return e
+    except OverflowError:
+        return MathError('the result is too large')
+
+
+class MathEvaluator:
+    # Evaluates expressions in worker processes under a memory limit and a timeout, so a pathological expression
+    # costs at most one worker restart and never blocks the event loop. Results and errors are cached by expression.
+    # A timed out expression is cached as an error too, so repeating it doesn't cost another restart.
+
+    def __init__(self,
+                 num_workers: int = 1,
+                 timeout: float = 1.0,
+                 max_memory_mb: float = 256,
+                 cache_size: int = 1024):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.max_memory = int(max_memory_mb * 2 ** 20)
+        self.cache = ExpiringLruCache(maxsize=cache_size)
+        self.pool = None  # type: Optional[multiprocessing.pool.Pool]
+        self.pending = set()  # type: Set[asyncio.Future]
+        self.restarts = 0
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.pool is None:
+                # forkserver: forking the bot itself would copy its threads' locks and its models
+                context = multiprocessing.get_context('forkserver')
+                self.pool = context.Pool(self.num_workers, initializer=_limit_memory, initargs=(self.max_memory,))
+
+    async def evaluate(self, expr: str) -> float:
+        expr = expr.strip()  # inner spaces are kept: '3 4' is not 34
+        if len(expr) > MAX_EXPR_LENGTH:
+            raise MathError('the expression is too long')
+        result = self.cache.get(expr)
+        if result is None:
+            result = await self._submit(expr)
+            if result is None:
+                raise MathError('the evaluation was aborted')
+            self.cache.put(expr, result)
+        if isinstance(result, MathError):
+            raise result
+        return result
+
+    async def _submit(self, expr: str):
+        loop = asyncio.get_event_loop()
+        if self.pool is None:
+            await loop.run_in_executor(None, self.start)
+        future = loop.create_future()
+
+        def resolve(result):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+        self.pending.add(future)
+        self.pool.apply_async(_evaluate,
+                              (expr,),
+                              callback=resolve,
+                              error_callback=lambda e: resolve(MathError('the evaluation ran out of memory')
+                                                               if isinstance(e, MemoryError) else None))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            await self._restart()
+            return MathError('the evaluation took too long')
+        finally:
+            self.pending.discard(future)
+
+    async def _restart(self):
+        # Kills the workers, along with whatever else they were evaluating
+        pool, self.pool = self.pool, None
+        for future in self.pending:
+            if not future.done():
+                future.set_result(None)
+        self.restarts += 1
+        if pool is not None:
+            await asyncio.get_event_loop().run_in_executor(None, pool.terminate)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence
+import sqlite3
+import threading
+import time
+
+
+__all__ = ['LemmaCache', 'ExpiringLruCache']
+
+
+class LemmaCache:
+    # Maps message text to its lemmatized string. A bounded in-memory LRU sits in front of an optional SQLite table
+    # that survives restarts and can be shared by several bot processes (WAL mode). `namespace` keeps lemmas from
+    # differently configured lemmatizers apart.
+
+    def __init__(self, maxsize: int = 10000, path: str = '', max_disk_entries: int = 1000000, namespace: str = ''):
+        self.maxsize = maxsize
+        self.max_disk_entries = max_disk_entries
+        self.namespace = namespace
+        self.entries = OrderedDict()  # type: OrderedDict[str, str]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_writes = 0
+        self.db = None  # type: Optional[sqlite3.Connection]
+        if path:
+            self.db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS lemmas (namespace TEXT, text TEXT, lemma TEXT, '
+                            'PRIMARY KEY (namespace, text))')
+
+    def stats(self) -> Dict[str, int]:
+        return dict(size=len(self.entries), hits=self.hits, disk_hits=self.disk_hits, misses=self.misses,
+                    evictions=self.evictions)
+
+    def _put(self, text: str, lemma: str):
+        self.entries[text] = lemma
+        self.entries.move_to_end(text)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, texts: Sequence[str]) -> Dict[str, str]:
+        found = {}
+        for text in texts:
+            lemma = self.entries.get(text)
+            if lemma is not None:
+                self.entries.move_to_end(text)
+                self.hits += 1
+                found[text] = lemma
+        missing = [x for x in texts if x not in found]
+        if self.db is None:
+            return found
+        for idx in range(0, len(missing), 500):  # stays under SQLite's host parameter limit
+            chunk = missing[idx:idx + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.db.execute(f'SELECT text, lemma FROM lemmas WHERE namespace = ? AND text IN ({placeholders})',
+                                   [self.namespace] + chunk).fetchall()
+            for text, lemma in rows:
+                self.disk_hits += 1
+                found[text] = lemma
+                self._put(text, lemma)
+        return found
+
+    def _store(self, lemma_map: Dict[str, str]):
+        for text, lemma in lemma_map.items():
+            self._put(text, lemma)
+        if self.db is None or not lemma_map:
+            return
+        self.db.executemany('INSERT OR REPLACE INTO lemmas VALUES (?, ?, ?)',
+                            [(self.namespace, text, lemma) for text, lemma in lemma_map.items()])
+        self.disk_writes += len(lemma_map)
+        if self.disk_writes >= self.max_disk_entries // 10:
+            self.disk_writes = 0
+            self.db.execute('DELETE FROM lemmas WHERE rowid <= (SELECT MAX(rowid) FROM lemmas) - ?',
+                            (self.max_disk_entries,))
+
+    def get(self, text: str, compute: Callable[[str], str]) -> str:
+        return self.get_many([text], lambda xs: [compute(x) for x in xs])[0]
+
+    def get_many(self, texts: Sequence[str], compute: Callable[[List[str]], List[str]]) -> List[str]:
+        with self.lock:
+            found = self._lookup(list(dict.fromkeys(texts)))
+        missing = [x for x in dict.fromkeys(texts) if x not in found]
+        if missing:
+            computed = dict(zip(missing, compute(missing)))
+            with self.lock:
+                self.misses += len(missing)
+                self._store(computed)
+            found.update(computed)
+        return [found[x] for x in texts]
+
+    async def get_many_async(self,
+                             texts: Sequence[str],
+                             compute: Callable[[List[str]], Awaitable[List[str]]]) -> List[str]:
+        with self.lock:
+            found = self._lookup(list(dict.fromkeys(texts)))
+        missing = [x for x in dict.fromkeys(texts) if x not in found]
+        if missing:
+            computed = dict(zip(missing, await compute(missing)))
+            with self.lock:
+                self.misses += len(missing)
+                self._store(computed)
+            found.update(computed)
+        return [found[x] for x in texts]
+
+
+class ExpiringLruCache:
+    # Least-recently-used mapping bounded by entry count, by idle time (`ttl` seconds since last access) and by the
+    # total of `weigh(value)` over its entries, e.g. bytes held.
+
+    def __init__(self,
+                 maxsize: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 max_weight: Optional[float] = None,
+                 weigh: Callable[[Any], float] = lambda x: 0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.clock = clock
+        self.entries = OrderedDict()  # type: OrderedDict[Hashable, List[Any]]
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def values(self):
+        return [x[0] for x in self.entries.values()]
+
+    def get(self, key: Hashable, default=None):
+        self.expire()
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        entry[1] = self.clock()
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value):
+        self.entries[key] = [value, self.clock()]
+        self.entries.move_to_end(key)
+        self.evict(keep=key)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def pop(self, key: Hashable, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def expire(self):
+        if self.ttl is None:
+            return
+        deadline = self.clock() - self.ttl
+        while self.entries:
+            key, (_, last_access) = next(iter(self.entries.items()))
+            if last_access >= deadline:
+                break
+            del self.entries[key]
+            self.expirations += 1
+
+    def evict(self, keep: Hashable = None):
+        # Drops least recently used entries (never `keep`) until the count and weight limits hold.
+        self.expire()
+        while self.maxsize is not None and len(self.entries) > self.maxsize and self._evict_oldest(keep):
+            pass
+        if self.max_weight is None:
+            return
+        weight = sum(self.weigh(x[0]) for x in self.entries.values())
+        while weight > self.max_weight:
+            key = next((k for k in self.entries if k != keep), None)
+            if key is None:
+                break
+            weight -= self.weigh(self.entries.pop(key)[0])
+            self.evictions += 1
+
+    def _evict_oldest(self, keep: Hashable) -> bool:
+        key = next((k for k in self.entries if k != keep), None)
+        if key is None:
+            return False
+        del self.entries[key]
+        self.evictions += 1
+        return True
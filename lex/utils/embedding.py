@@ -0,0 +1,84 @@
+from collections import Counter
+from typing import List, Sequence, Tuple
+import re
+import zlib
+
+import numpy as np
+
+
+__all__ = ['HashedNgramEmbedder', 'EmbeddingIndex']
+
+
+WORD_RGX = re.compile(r'\w+')
+STOP_WORDS = frozenset('a an and are be can could do does for from get got how i im in is it me my of on or please '
+                       'should so some someone tell that the there this to u we what whats where which who why will with '
+                       'would you'.split())
+
+
+class HashedNgramEmbedder:
+    # Bag of words, word bigrams and character n-grams of each word, hashed into `dim` signed buckets. Function words
+    # are dropped, since FAQ questions mostly share them. Hashing is stable across processes (crc32 rather than
+    # `hash`), so embeddings can be cached on disk.
+
+    def __init__(self, dim: int = 2048, char_ngrams: Tuple[int, int] = (3, 5)):
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+
+    def grams(self, text: str) -> List[str]:
+        words = [x for x in WORD_RGX.findall(text.lower()) if x not in STOP_WORDS]
+        grams = [f'w:{x}' for x in words]
+        grams.extend(f'b:{a} {b}' for a, b in zip(words, words[1:]))
+        lo, hi = self.char_ngrams
+        for word in words:
+            word = f'<{word}>'
+            for n in range(lo, hi + 1):
+                grams.extend(word[idx:idx + n] for idx in range(len(word) - n + 1))
+        return grams
+
+    def features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the bucket indices and signed counts of the text's grams, unweighted and unnormalized.
+        counts = Counter()
+        for gram in self.grams(text):
+            h = zlib.crc32(gram.encode('utf-8'))
+            counts[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        idxs = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        return idxs, values
+
+
+class EmbeddingIndex:
+    # Cosine similarity between a text and every indexed text, with features weighted by inverse document
+    # frequency over the indexed texts. The matrix is stored transposed (one row per feature), so scoring only
+    # gathers the rows of the query's nonzero features: the cost grows with the number of texts, not with `dim`.
+
+    def __init__(self, texts: Sequence[str], embedder: HashedNgramEmbedder = None):
+        self.embedder = embedder or HashedNgramEmbedder()
+        features = [self.embedder.features(x) for x in texts]
+        df = np.zeros(self.embedder.dim, dtype=np.float32)
+        for idxs, _ in features:
+            df[idxs] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        self.matrix_t = np.zeros((self.embedder.dim, len(texts)), dtype=np.float32)
+        for col, (idxs, values) in enumerate(features):
+            weights = values * self.idf[idxs]
+            self.matrix_t[idxs, col] = weights / max(float(np.linalg.norm(weights)), 1e-8)
+
+    def __len__(self):
+        return self.matrix_t.shape[1]
+
+    def scores(self, text: str) -> np.ndarray:
+        idxs, values = self.embedder.features(text)
+        if not len(idxs) or not len(self):
+            return np.zeros(len(self), dtype=np.float32)
+        weights = values * self.idf[idxs]
+        weights /= max(float(np.linalg.norm(weights)), 1e-8)
+        return weights @ self.matrix_t[idxs]
+
+    def top_k(self, text: str, k: int = 1) -> List[Tuple[int, float]]:
+        scores = self.scores(text)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(x), float(scores[x])) for x in top]
@@ -0,0 +1,71 @@
+from typing import List, Sequence
+import re
+
+
+__all__ = ['StanzaLemmatizer', 'DictionaryLemmatizer']
+
+
+class StanzaLemmatizer:
+    # Expects a pipeline built with `tokenize_no_ssplit=True`, so every paragraph comes back as exactly one sentence
+    # and a batch of messages can be parsed in a single call by joining them with blank lines.
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def lemmatize(self, text: str) -> str:
+        doc = self.pipeline(text)
+        return ' '.join([word.lemma for sent in doc.sentences for word in sent.words])
+
+    def lemmatize_batch(self, texts: Sequence[str]) -> List[str]:
+        texts = [' '.join(x.split()) for x in texts]
+        idxs = [idx for idx, text in enumerate(texts) if text]
+        if not idxs:
+            return [''] * len(texts)
+        doc = self.pipeline('\n\n'.join(texts[idx] for idx in idxs))
+        if len(doc.sentences) != len(idxs):
+            return [self.lemmatize(text) if text else '' for text in texts]
+        lemmas = [''] * len(texts)
+        for idx, sent in zip(idxs, doc.sentences):
+            lemmas[idx] = ' '.join([word.lemma for word in sent.words])
+        return lemmas
+
+
+class DictionaryLemmatizer:
+    # Lower-cases, splits off punctuation and English clitics, then maps irregular forms through a small table and
+    # strips regular plural endings. Needs no models, at the cost of missing what a tagger would disambiguate.
+    token_rgx = re.compile(r"\w+?(?=n't\b)|n't|'(?:s|m|re|ll|ve|d)\b|\w+|[^\w\s]")
+    irregular_map = {
+        'am': 'be', 'is': 'be', 'are': 'be', 'was': 'be', 'were': 'be', 'been': 'be', 'being': 'be', "'s": 'be',
+        "'m": 'be', "'re": 'be', 'has': 'have', 'had': 'have', 'having': 'have', "'ve": 'have', 'does': 'do',
+        'did': 'do', 'done': 'do', 'doing': 'do', "n't": 'not', "'ll": 'will', "'d": 'would', 'went': 'go',
+        'gone': 'go', 'goes': 'go', 'got': 'get', 'gotten': 'get', 'made': 'make', 'said': 'say', 'says': 'say',
+        'saw': 'see', 'seen': 'see', 'knew': 'know', 'known': 'know', 'came': 'come', 'took': 'take', 'taken': 'take',
+        'gave': 'give', 'given': 'give', 'found': 'find', 'thought': 'think', 'told': 'tell', 'became': 'become',
+        'left': 'leave', 'felt': 'feel', 'brought': 'bring', 'began': 'begin', 'kept': 'keep', 'held': 'hold',
+        'wrote': 'write', 'stood': 'stand', 'heard': 'hear', 'meant': 'mean', 'met': 'meet', 'ran': 'run',
+        'paid': 'pay', 'sat': 'sit', 'spoke': 'speak', 'built': 'build', 'sent': 'send', 'spent': 'spend',
+        'won': 'win', 'lost': 'lose', 'bought': 'buy', 'died': 'die', 'men': 'man', 'women': 'woman',
+        'children': 'child', 'people': 'person', 'feet': 'foot', 'teeth': 'tooth', 'mice': 'mouse', 'better': 'good',
+        'worse': 'bad', 'worst': 'bad', 'us': 'we', 'me': 'I', 'i': 'I', 'him': 'he', 'them': 'they', 'his': 'he',
+        'ca': 'can', 'wo': 'will', 'always': 'always', 'perhaps': 'perhaps', 'whos': 'whos', 'news': 'news',
+        'series': 'series', 'species': 'species',
+    }
+
+    def lemmatize_word(self, word: str) -> str:
+        word = word.lower()
+        lemma = self.irregular_map.get(word)
+        if lemma is not None:
+            return lemma
+        if len(word) > 4 and word.endswith('ies'):
+            return f'{word[:-3]}y'
+        if len(word) > 4 and word.endswith(('sses', 'shes', 'ches', 'xes', 'zes')):
+            return word[:-2]
+        if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+            return word[:-1]
+        return word
+
+    def lemmatize(self, text: str) -> str:
+        return ' '.join(self.lemmatize_word(x) for x in self.token_rgx.findall(text))
+
+    def lemmatize_batch(self, texts: Sequence[str]) -> List[str]:
+        return [self.lemmatize(x) for x in texts]
@@ -1,75 +1,240 @@
-from functools import lru_cache
-import ast
-import operator as op
+from typing import List, Optional, Tuple
+import asyncio
+import os
+import threading
 
-import stanza
-import torch
-stanza.download('en')
-PIPELINE = stanza.Pipeline('en')
+from pydantic import BaseSettings
 
+from .cache import LemmaCache
+from .lemma import StanzaLemmatizer, DictionaryLemmatizer
+from .metrics import METRICS, timed
 
-@lru_cache(maxsize=10000)
-def nlp(text: str):
-    return PIPELINE(text)
 
+class NlpSettings(BaseSettings):
+    nlp_lang: str = 'en'
+    nlp_dir: str = ''
+    nlp_offline: bool = False
+    nlp_backend: str = 'stanza'  # or 'dictionary'
+    nlp_processors: str = 'tokenize,pos,lemma'
+    nlp_cache_size: int = 10000
+    nlp_cache_path: str = ''
+    nlp_cache_disk_size: int = 1000000
+    nlp_server: str = ''  # address of an inference server to lemmatize with, instead of loading stanza
+    nlp_server_timeout: float = 5
 
-MATH_OPS = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul, ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor, ast.USub: op.neg}
 
+NLP_SETTINGS = NlpSettings()
+_LEMMATIZER = None
+_LEMMATIZER_LOCK = threading.Lock()
+_LEMMA_CACHE = None
+_PREFETCH_QUEUE = []  # type: List[Tuple[List[str], asyncio.Future]]
+_PREFETCH_TASK = None  # type: Optional[asyncio.Task]
+_PREFETCH_EXECUTOR = None
+_LEMMATIZE_LOCK = threading.Lock()
 
-def eval_expr(expr):
-    return eval_(ast.parse(expr, mode='eval').body)
 
+def build_pipeline(settings: NlpSettings):
+    # stanza is only asked to download when the models aren't cached locally.
+    import stanza
+    from stanza.resources.common import DEFAULT_MODEL_DIR
+    model_dir = settings.nlp_dir or DEFAULT_MODEL_DIR
+    if not os.path.isdir(os.path.join(model_dir, settings.nlp_lang)):
+        if settings.nlp_offline:
+            raise FileNotFoundError(f'No stanza models for {settings.nlp_lang} in {model_dir} (offline)')
+        stanza.download(settings.nlp_lang, dir=model_dir, processors=settings.nlp_processors)
+    return stanza.Pipeline(settings.nlp_lang, dir=model_dir, processors=settings.nlp_processors, tokenize_no_ssplit=True)
 
-def eval_(node):
-    if isinstance(node, ast.Num): # <number>
-        return node.n
-    elif isinstance(node, ast.BinOp): # <left> <operator> <right>
-        return MATH_OPS[type(node.op)](eval_(node.left), eval_(node.right))
-    elif isinstance(node, ast.UnaryOp): # <operator> <operand> e.g., -1
-        return MATH_OPS[type(node.op)](eval_(node.operand))
+
+def get_lemmatizer():
+    global _LEMMATIZER
+    with _LEMMATIZER_LOCK:
+        if _LEMMATIZER is None:
+            if NLP_SETTINGS.nlp_server:
+                from lex.inference.remote import RemoteLemmatizer
+                _LEMMATIZER = RemoteLemmatizer(NLP_SETTINGS.nlp_server, timeout=NLP_SETTINGS.nlp_server_timeout)
+            elif NLP_SETTINGS.nlp_backend == 'dictionary':
+                _LEMMATIZER = DictionaryLemmatizer()
+            else:
+                _LEMMATIZER = StanzaLemmatizer(build_pipeline(NLP_SETTINGS))
+        return _LEMMATIZER
+
+
+def get_lemma_cache() -> LemmaCache:
+    global _LEMMA_CACHE
+    with _LEMMATIZER_LOCK:
+        if _LEMMA_CACHE is None:
+            s = NLP_SETTINGS
+            namespace = s.nlp_backend if s.nlp_backend == 'dictionary' else f'{s.nlp_lang}:{s.nlp_processors}'
+            if s.nlp_server:
+                namespace = f'server:{s.nlp_server}'
+            _LEMMA_CACHE = LemmaCache(s.nlp_cache_size, s.nlp_cache_path, s.nlp_cache_disk_size, namespace=namespace)
+            METRICS.gauge('lex_lemma_cache_size', lambda: _LEMMA_CACHE.stats()['size'], 'Lemmas held in memory')
+            for name in ('hits', 'disk_hits', 'misses', 'evictions'):
+                METRICS.gauge(f'lex_lemma_cache_{name}_total', lambda name=name: _LEMMA_CACHE.stats()[name],
+                              kind='counter')
+        return _LEMMA_CACHE
+
+
+def _lemmatize_batch(texts: List[str]) -> List[str]:
+    with _LEMMATIZE_LOCK:  # prefetching runs the lemmatizer on a worker thread, and stanza isn't thread-safe
+        return get_lemmatizer().lemmatize_batch(texts)
+
+
+def lemmatize(text: str) -> str:
+    with timed('lex_lemmatize_seconds'):
+        return get_lemma_cache().get(text, lambda x: _lemmatize_batch([x])[0])
+
+
+def lemmatize_batch(texts: List[str]) -> List[str]:
+    with timed('lex_lemmatize_seconds'):
+        return get_lemma_cache().get_many(texts, _lemmatize_batch)
+
+
+async def prefetch_lemmas(texts: List[str]):
+    # Fills the lemma cache without blocking the event loop, so that predictors calling lemmatize() on these texts
+    # hit it. Texts queued while a batch is being lemmatized go together into the next lemmatize_batch call, on a
+    # worker thread or through the inference server. Best effort: on errors, predictors lemmatize on demand.
+    global _PREFETCH_TASK
+    future = asyncio.get_event_loop().create_future()
+    _PREFETCH_QUEUE.append((texts, future))
+    if _PREFETCH_TASK is None or _PREFETCH_TASK.done():
+        _PREFETCH_TASK = asyncio.ensure_future(_prefetch_batches())
+    await future
+
+
+async def _prefetch_batches():
+    global _PREFETCH_EXECUTOR
+    if NLP_SETTINGS.nlp_server:
+        from lex.inference.remote import InferenceClient
+        client = InferenceClient.shared(NLP_SETTINGS.nlp_server)
+
+        def compute(xs):
+            return client.call('lemmatize', texts=xs)
     else:
-        raise TypeError(node)
+        from lex.inference.executor import InferenceExecutor
+        if _PREFETCH_EXECUTOR is None:
+            _PREFETCH_EXECUTOR = InferenceExecutor(1, name='nlp')
 
+        def compute(xs):
+            return _PREFETCH_EXECUTOR.submit(_lemmatize_batch, xs)
+    while _PREFETCH_QUEUE:
+        await asyncio.sleep(0)  # lets messages that arrived together queue their texts
+        batch = list(_PREFETCH_QUEUE)
+        _PREFETCH_QUEUE.clear()
+        try:
+            with timed('lex_lemmatize_seconds'):
+                await get_lemma_cache().get_many_async([x for texts, _ in batch for x in texts], compute)
+        except Exception as e:
+            print(f'Could not prefetch lemmas: {e!r}')
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
 
-def sample_gpt2(model, tokenizer, cond_text, max_length=64, eos_token=' |', max_count=30, min_text_len=20):
-    eos_token_id = tokenizer.encode(eos_token)[0]
-    ids = [tokenizer.encode(cond_text)]
-    ids = torch.tensor(ids).cuda()
-    token_ids = model.generate(ids, do_sample=True, max_length=64,
-                                    eos_token_id=eos_token_id)
-    token_ids = token_ids[0]
-    token_ids = token_ids[ids.size(1):]
-    text = tokenizer.decode(tokenizer.encode('a') + token_ids.tolist())[1:]
+
+def encode(tokenizer, text: str) -> List[int]:
+    with timed('lex_tokenize_seconds'):
+        return tokenizer.encode(text)
+
+
+def decode_sample(tokenizer, token_ids, eos_token=' |'):
+    text = tokenizer.decode(tokenizer.encode('a') + list(token_ids))[1:]
     text = text.replace(eos_token, '').rstrip()
     if '<|endoftext|>' in text:
         idx = text.find('<|endoftext|>')
         text = text[:idx]
-    if len(text) < min_text_len and max_count > 0:
-        return sample_gpt2(model,
-                           tokenizer,
-                           cond_text,
-                           max_length=max_length,
-                           eos_token=eos_token,
-                           max_count=max_count - 1,
-                           min_text_len=min_text_len)
-    else:
-        return text
+    return text
+
+
+def pick_candidate(texts, min_text_len):
+    for text in texts:
+        if len(text) >= min_text_len:
+            return text
+    return None
+
+
+async def sample_gpt2(scheduler,
+                      tokenizer,
+                      cond_text,
+                      max_length=64,
+                      eos_token=' |',
+                      num_candidates=4,
+                      max_passes=2,
+                      min_text_len=20,
+                      min_tokens=None):
+    eos_token_id = tokenizer.encode(eos_token)[0]
+    ids = encode(tokenizer, cond_text)
+    if min_tokens is None:
+        min_tokens = min_text_len // 4
+    min_length = min(len(ids) + min_tokens, max_length)
+    texts = []
+    for _ in range(max_passes):
+        candidates = await scheduler.generate(ids, max_length, eos_token_id, min_length=min_length,
+                                              num_return_sequences=num_candidates)
+        texts = [decode_sample(tokenizer, x, eos_token=eos_token) for x in candidates]
+        text = pick_candidate(texts, min_text_len)
+        if text is not None:
+            return text
+    return max(texts, key=len)
+
+
+async def stream_sample(scheduler,
+                        tokenizer,
+                        ids,
+                        max_length=64,
+                        eos_token=' |',
+                        min_length=0,
+                        prefix_cache=None):
+    # Yields the decoded text generated so far every time it grows, while the sample is being generated.
+    eos_token_id = tokenizer.encode(eos_token)[0]
+    tokens = asyncio.Queue()
+    task = asyncio.ensure_future(scheduler.generate(ids, max_length, eos_token_id, min_length=min_length,
+                                                    prefix_cache=prefix_cache, on_token=tokens.put_nowait))
+    task.add_done_callback(lambda _: tokens.put_nowait(None))
+    token_ids = []
+    text = ''
+    while True:
+        token = await tokens.get()
+        if token is None:
+            break
+        token_ids.append(token)
+        # A trailing replacement character is an incomplete multi-byte character split across tokens
+        new_text = decode_sample(tokenizer, token_ids, eos_token=eos_token).rstrip('\ufffd')
+        if len(new_text) > len(text):
+            text = new_text
+            yield text
+    await task
+
+
+async def stream_gpt2(scheduler,
+                      tokenizer,
+                      cond_text,
+                      max_length=64,
+                      eos_token=' |',
+                      min_tokens=5):
+    ids = encode(tokenizer, cond_text)
+    async for text in stream_sample(scheduler,
+                                    tokenizer,
+                                    ids,
+                                    max_length=max_length,
+                                    eos_token=eos_token,
+                                    min_length=min(len(ids) + min_tokens, max_length)):
+        yield text
 
 
-def sample_gpt2_mc_dialogue(model,
-                            tokenizer,
-                            username_target,
-                            username_source,
-                            source_text,
-                            max_length=64,
-                            max_count=30,
-                            min_text_len=20):
+async def sample_gpt2_mc_dialogue(scheduler,
+                                  tokenizer,
+                                  username_target,
+                                  username_source,
+                                  source_text,
+                                  max_length=64,
+                                  num_candidates=4,
+                                  min_text_len=20):
     username_target = username_target.replace('@', '')
     cond_text = f'{username_source} {source_text} |{username_target} '
-    gen_text = sample_gpt2(model,
-                           tokenizer,
-                           cond_text,
-                           max_length=max_length,
-                           max_count=max_count,
-                           min_text_len=min_text_len)
+    gen_text = await sample_gpt2(scheduler,
+                                 tokenizer,
+                                 cond_text,
+                                 max_length=max_length,
+                                 num_candidates=num_candidates,
+                                 min_text_len=min_text_len)
     return f'<{username_target}>{gen_text}'
@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import threading
+import time
+
+
+__all__ = ['Counter', 'Histogram', 'Timer', 'MetricsRegistry', 'METRICS', 'timed', 'serve_metrics', 'log_metrics']
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Counter:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self, lock: threading.Lock):
+        self.value = 0.0
+        self.lock = lock
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    # Fixed buckets, so an observation is a bisect and two additions under a lock shared by the registry.
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'lock')
+
+    def __init__(self, buckets: Sequence[float], lock: threading.Lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = lock
+
+    def observe(self, value: float):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        # Estimated by linear interpolation within the bucket that holds the quantile.
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Optional[Histogram]):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        if self.histogram is not None:
+            self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    # Counters and histograms by name and labels, plus gauges read from callbacks when the metrics are collected.
+    # Renders the Prometheus text format or a short human-readable summary.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # type: Dict[str, Dict[LabelKey, Counter]]
+        self.histograms = {}  # type: Dict[str, Dict[LabelKey, Histogram]]
+        self.gauges = {}  # type: Dict[str, Tuple[Callable[[], float], str]]
+        self.help = {}  # type: Dict[str, str]
+        self.enabled = True
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        key = tuple(sorted(labels.items()))
+        family = self.counters.get(name)
+        if family is None or key not in family:
+            with self.lock:
+                family = self.counters.setdefault(name, {})
+                family.setdefault(key, Counter(self.lock))
+                self.help.setdefault(name, help)
+        return family[key]
+
+    def histogram(self, name: str, help: str = '', buckets: Sequence[float] = SECONDS_BUCKETS, **labels) -> Histogram:
+        key = tuple(sorted(labels.items())) if labels else ()
+        family = self.histograms.get(name)
+        if family is None or key not in family:
+            with self.lock:
+                family = self.histograms.setdefault(name, {})
+                family.setdefault(key, Histogram(buckets, self.lock))
+                self.help.setdefault(name, help)
+        return family[key]
+
+    def gauge(self, name: str, fn: Callable[[], float], help: str = '', kind: str = 'gauge'):
+        # `kind` is 'counter' for totals kept elsewhere, e.g. in a queue's own counters
+        self.gauges[name] = fn, kind
+        self.help[name] = help
+
+    def timer(self, name: str, **labels) -> 'Timer':
+        return Timer(self.histogram(name, **labels) if self.enabled else None)
+
+    def _snapshot(self, families: Dict[str, Dict[LabelKey, object]]) -> List[Tuple[str, List[Tuple[LabelKey, object]]]]:
+        # Other threads may add labels while the metrics are collected
+        with self.lock:
+            return sorted((name, sorted(family.items())) for name, family in families.items())
+
+    def render(self) -> str:
+        lines = []  # type: List[str]
+
+        def header(name, kind):
+            if self.help.get(name):
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for name, family in self._snapshot(self.counters):
+            header(name, 'counter')
+            for key, counter in family:
+                lines.append(f'{name}{_labels(key)} {counter.value}')
+        for name, family in self._snapshot(self.histograms):
+            header(name, 'histogram')
+            for key, hist in family:
+                cumulative = 0
+                for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(key + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(key)} {hist.sum}')
+                lines.append(f'{name}_count{_labels(key)} {hist.count}')
+        for name, (fn, kind) in sorted(self.gauges.items()):
+            header(name, kind)
+            lines.append(f'{name} {fn()}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        lines = []
+        for name, family in self._snapshot(self.histograms):
+            for key, hist in family:
+                if not hist.count:
+                    continue
+                if name.endswith('_seconds'):
+                    p50, p95, p99 = (hist.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+                    lines.append(f'{name}{_labels(key)}: n={hist.count} p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms')
+                else:  # e.g. row counts, in their own units
+                    p50, p95, p99 = (hist.quantile(q) for q in (0.5, 0.95, 0.99))
+                    lines.append(f'{name}{_labels(key)}: n={hist.count} p50={p50:.1f} p95={p95:.1f} p99={p99:.1f}')
+        for name, family in self._snapshot(self.counters):
+            for key, counter in family:
+                lines.append(f'{name}{_labels(key)}: {counter.value:g}')
+        lines.extend(f'{name}: {fn():g}' for name, (fn, _) in sorted(self.gauges.items()))
+        return '\n'.join(lines)
+
+
+def _labels(key: LabelKey) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in key) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = MetricsRegistry()
+
+
+def timed(name: str, **labels):
+    return METRICS.timer(name, **labels)
+
+
+async def serve_metrics(host: str = '127.0.0.1', port: int = 9090, registry: MetricsRegistry = METRICS):
+    # Serves the Prometheus text format at /metrics. aiohttp comes with discord.py.
+    from aiohttp import web
+
+    async def handle(_):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def log_metrics(interval: float, registry: MetricsRegistry = METRICS):
+    while True:
+        await asyncio.sleep(interval)
+        print(f'Metrics:\n{registry.summary()}')
@@ -0,0 +1,117 @@
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Pattern, Sequence, Tuple
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+__all__ = ['RegexIndex']
+
+
+MIN_KEY_LENGTH = 3
+MIN_INDEXED_PATTERNS = 16  # below this, trying every pattern is cheaper than looking up trigrams
+
+
+def _trigrams(text: str):
+    return {text[idx:idx + 3] for idx in range(len(text) - 2)}
+
+
+def _literal_keys(items) -> Optional[List[str]]:
+    # Returns literals of which at least one occurs in every string the parsed pattern matches, preferring the
+    # longest guarantee, or None if there's no such literal of at least MIN_KEY_LENGTH characters.
+    best = None  # type: Optional[List[str]]
+    run = []
+
+    def consider(keys):
+        nonlocal best
+        if keys and min(map(len, keys)) >= MIN_KEY_LENGTH:
+            if best is None or min(map(len, keys)) > min(map(len, best)):
+                best = keys
+
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if op is sre_parse.AT:  # zero-width, keeps the run contiguous
+            continue
+        consider([''.join(run)])
+        run = []
+        if op is sre_parse.SUBPATTERN:
+            consider(_literal_keys(av[-1]))
+        elif op is sre_parse.BRANCH:
+            alt_keys = [_literal_keys(alt) for alt in av[1]]
+            if all(keys is not None for keys in alt_keys):
+                consider([key for keys in alt_keys for key in keys])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            consider(_literal_keys(av[2]))
+    consider([''.join(run)])
+    return best
+
+
+class RegexIndex:
+    # Matches text against many patterns without trying each one. Every pattern is indexed under one trigram of a
+    # literal it requires (the rarest trigram among all patterns), so a message only runs the patterns whose
+    # trigram it contains, plus those without a usable literal. `match` returns the first pattern in order that
+    # matches, with the groups and groupdict of a plain `pattern.match`. A pickled index keeps the pattern sources
+    # and compiles each pattern again only once a message first reaches it.
+
+    def __init__(self, patterns: Sequence[Pattern]):
+        self.patterns = list(patterns)  # type: List[Optional[Pattern]]
+        self.sources = [(x.pattern, x.flags) for x in self.patterns]
+        self.unindexed_idxs = []  # type: List[int]
+        self.trigram_idxs = defaultdict(list)  # type: Dict[str, List[int]]
+        if len(self.patterns) < MIN_INDEXED_PATTERNS:
+            self.unindexed_idxs = list(range(len(self.patterns)))
+            return
+        pattern_keys = [self._pattern_keys(x) for x in self.patterns]
+        counts = Counter(t for keys in pattern_keys if keys for key in keys for t in _trigrams(key))
+        for idx, keys in enumerate(pattern_keys):
+            if keys is None:
+                self.unindexed_idxs.append(idx)
+                continue
+            for key in keys:
+                self.trigram_idxs[min(_trigrams(key), key=lambda t: (counts[t], t))].append(idx)
+
+    @staticmethod
+    def _pattern_keys(pattern: Pattern) -> Optional[List[str]]:
+        if not isinstance(pattern.pattern, str):
+            return None
+        try:
+            keys = _literal_keys(sre_parse.parse(pattern.pattern, pattern.flags))
+        except Exception:
+            return None
+        if keys is None:
+            return None
+        if pattern.flags & re.IGNORECASE and not all(key.isascii() for key in keys):
+            return None  # Unicode case folding can match literals that lower() doesn't produce
+        return [key.lower() for key in keys]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['patterns'] = [None] * len(self.patterns)
+        return state
+
+    def pattern(self, idx: int) -> Pattern:
+        pattern = self.patterns[idx]
+        if pattern is None:
+            pattern = self.patterns[idx] = re.compile(*self.sources[idx])
+        return pattern
+
+    def candidates(self, text: str) -> List[int]:
+        if not self.trigram_idxs:
+            return self.unindexed_idxs
+        idxs = set(self.unindexed_idxs)
+        for trigram in _trigrams(text.lower()):
+            idxs.update(self.trigram_idxs.get(trigram, ()))
+        return sorted(idxs)
+
+    def match(self, text: str) -> Optional[Tuple[int, Tuple[Any, ...], Dict[str, Any]]]:
+        # Returns the index of the first matching pattern with its groups and groupdict, or None.
+        for idx in self.candidates(text):
+            m = self.pattern(idx).match(text)
+            if m is not None:
+                return idx, m.groups(), m.groupdict()
+        return None